@@ -0,0 +1,105 @@
+#
+# This file is part of Kritter 
+#
+# All Kritter source code is provided under the terms of the
+# GNU General Public License v2 (http://www.gnu.org/licenses/gpl-2.0.html).
+# Those wishing to use Kritter source code, software and/or
+# technologies under different licensing terms should contact us at
+# support@charmedlabs.com. 
+#
+
+import time
+import numpy as np
+from kritter.detectiontracker import DetectionTracker, iou
+
+'''
+Benchmark of DetectionTracker.update() with 10, 100 and 500 objects, comparing
+the vectorized association (linear_sum_assignment matching, vectorized overlap
+removal) against the original greedy matching and pairwise overlap loop. 
+'''
+
+FRAMES = 100
+RESOLUTION = (1920, 1080)
+BOX_SIZE = 40
+CLASSES = ["person", "car", "dog", "bird"]
+
+
+# Original greedy matching and O(n^2) overlap removal
+class LegacyDetectionTracker(DetectionTracker):
+    def match(self, D):
+        rows = D.min(axis=1).argsort()
+        cols = D.argmin(axis=1)[rows]
+        usedRows = set()
+        usedCols = set()
+        matches = []
+        for (row, col) in zip(rows, cols):
+            if row in usedRows or col in usedCols:
+                continue
+            if D[row, col] > self.maxDistance:
+                continue
+            matches.append((row, col))
+            usedRows.add(row)
+            usedCols.add(col)
+        matches = np.array(matches, dtype=int).reshape(-1, 2)
+        return matches[:, 0], matches[:, 1]
+
+    def removeOverlaps(self):
+        ious = {}
+        deregs = set()
+        for i in range(self.n):
+            for j in range(i):
+                ious[(i, j)] = iou(self.boxes[i], self.boxes[j])
+        ious = {k: v for k, v in sorted(ious.items(), key=lambda item: item[1], reverse=True)}
+        for k, v in ious.items():
+            if v>=self.iouEquiv:
+                i, j = k
+                if self.classSwitch:
+                    if self.histLen[i]>self.histLen[j]:
+                        deregs.add(j)
+                    else:
+                        deregs.add(i)
+                else:
+                    if self.histClass[i, 0]==self.histClass[j, 0]:
+                        if self.histScore[i, 0]>self.histScore[j, 0]:
+                            deregs.add(j)
+                        else:
+                            deregs.add(i)
+            else: 
+                break
+        remove = np.zeros(self.n, dtype=bool)
+        remove[list(deregs)] = True
+        self._remove(remove)
+
+
+def scene(n, frames, seed=0):
+    # n objects wandering around with some detection jitter and dropouts
+    rng = np.random.default_rng(seed)
+    pos = rng.uniform((0, 0), (RESOLUTION[0]-BOX_SIZE, RESOLUTION[1]-BOX_SIZE), (n, 2))
+    vel = rng.normal(0, 5, (n, 2))
+    index = rng.integers(0, len(CLASSES), n)
+    res = []
+    for f in range(frames):
+        pos = np.clip(pos + vel, 0, (RESOLUTION[0]-BOX_SIZE, RESOLUTION[1]-BOX_SIZE))
+        dets = []
+        for i in range(n):
+            if rng.random()<0.05:
+                continue
+            x, y = (pos[i] + rng.normal(0, 2, 2)).astype(int)
+            dets.append({"box": [int(x), int(y), int(x+BOX_SIZE), int(y+BOX_SIZE)], "class": CLASSES[index[i]], "score": float(rng.uniform(0.5, 1)), "index": int(index[i])})
+        res.append(dets)
+    return res
+
+def bench(Tracker, dets):
+    tracker = Tracker(maxDisappeared=5, maxDistance=100)
+    t0 = time.time()
+    for d in dets:
+        tracker.update(d)
+    return (time.time()-t0)/len(dets)
+
+
+if __name__ == "__main__":
+    for n in (10, 100, 500):
+        dets = scene(n, FRAMES)
+        legacy = bench(LegacyDetectionTracker, dets)
+        new = bench(DetectionTracker, dets)
+        print(f"{n} objects: legacy {legacy*1000:.2f} ms/frame, vectorized {new*1000:.2f} ms/frame, speedup {legacy/new:.1f}x")
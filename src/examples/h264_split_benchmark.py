@@ -0,0 +1,71 @@
+#
+# This file is part of Kritter 
+#
+# All Kritter source code is provided under the terms of the
+# GNU General Public License v2 (http://www.gnu.org/licenses/gpl-2.0.html).
+# Those wishing to use Kritter source code, software and/or
+# technologies under different licensing terms should contact us at
+# support@charmedlabs.com. 
+#
+
+import os
+import sys
+import timeit
+from kritter.h264 import H264Encoder
+
+'''
+Microbenchmark of H264Encoder._split_bitstream against the original byte-by-byte
+implementation.  Pass one or more recorded Annex-B bitstreams (raw .h264 files, 
+one encoded frame per file, for example dumped from kritter.Encoder.encode()) on 
+the command line.  Without arguments, a synthetic keyframe-sized bitstream is used.
+'''
+
+# Original implementation, translated from: 
+# https://github.com/aizvorski/h264bitstream/blob/master/h264_nal.c#L134
+def split_bitstream_legacy(buf):
+    i = 0
+    while True:
+        while (buf[i] != 0 or buf[i + 1] != 0 or buf[i + 2] != 0x01) and (
+            buf[i] != 0 or buf[i + 1] != 0 or buf[i + 2] != 0 or buf[i + 3] != 0x01
+        ):
+            i += 1  # skip leading zero
+            if i + 4 >= len(buf):
+                return
+        if buf[i] != 0 or buf[i + 1] != 0 or buf[i + 2] != 0x01:
+            i += 1
+        i += 3
+        nal_start = i
+        while (buf[i] != 0 or buf[i + 1] != 0 or buf[i + 2] != 0) and (
+            buf[i] != 0 or buf[i + 1] != 0 or buf[i + 2] != 0x01
+        ):
+            i += 1
+            if i + 3 >= len(buf):
+                nal_end = len(buf)
+                yield buf[nal_start:nal_end]
+                return  
+        nal_end = i
+        yield buf[nal_start:nal_end]
+
+def synthetic_bitstream():
+    # SPS, PPS, and an IDR slice about the size of a 1080p keyframe.  Avoid 
+    # zero bytes in the payloads so we don't create emulated start codes.
+    payload = bytes((i*7)%255 + 1 for i in range(200000))
+    return b'\x00\x00\x00\x01\x67' + payload[:20] + b'\x00\x00\x00\x01\x68' + payload[:4] + b'\x00\x00\x01\x65' + payload 
+
+def bench(name, buf, number):
+    legacy = [bytes(n) for n in split_bitstream_legacy(buf)]
+    new = [bytes(n) for n in H264Encoder._split_bitstream(buf)]
+    if legacy!=new:
+        print(f"{name}: results differ! ({len(legacy)} vs {len(new)} NAL units)")
+    t_legacy = timeit.timeit(lambda: list(split_bitstream_legacy(buf)), number=number)/number
+    t_new = timeit.timeit(lambda: list(H264Encoder._split_bitstream(buf)), number=number)/number
+    print(f"{name}: {len(buf)} bytes, {len(new)} NAL units, legacy {t_legacy*1000:.3f} ms, new {t_new*1000:.3f} ms, speedup {t_legacy/t_new:.1f}x")
+
+
+if __name__ == "__main__":
+    if len(sys.argv)>1:
+        for filename in sys.argv[1:]:
+            with open(filename, 'rb') as file:
+                bench(os.path.basename(filename), file.read(), 10)
+    else:
+        bench("synthetic", synthetic_bitstream(), 10)
@@ -0,0 +1,108 @@
+#
+# This file is part of Kritter
+#
+# All Kritter source code is provided under the terms of the
+# GNU General Public License v2 (http://www.gnu.org/licenses/gpl-2.0.html).
+# Those wishing to use Kritter source code, software and/or
+# technologies under different licensing terms should contact us at
+# support@charmedlabs.com.
+#
+
+import time
+import numpy as np
+from multiprocessing.managers import BaseManager
+from kritter.processify import Processify
+
+'''
+Benchmark of Processify calls/sec, comparing the original implementation
+(a synchronous BaseManager round trip per call, arrays pickled) with
+synchronous calls, pipelined call_async() calls and batch() calls, for small
+calls and for calls that pass a camera-sized frame.
+'''
+
+CALLS = 1000
+FRAME_CALLS = 50
+FRAME_SHAPE = (1520, 2016, 3)
+BATCH = 10
+
+
+class Worker:
+    def nop(self):
+        return None
+
+    def mean(self, frame):
+        return float(frame[0, 0, 0])
+
+
+class _LegacyManager(BaseManager):
+    pass
+
+def _legacy_server(Cls):
+    obj = Cls()
+    _LegacyManager.register('server', callable=lambda: obj)
+
+# Original Processify
+class LegacyProcessify:
+    def __init__(self, Cls, socket):
+        _LegacyManager.register('server')
+        self.manager = _LegacyManager(address=('localhost', socket), authkey=Cls.__name__.encode())
+        self.manager.start(initializer=lambda: _legacy_server(Cls))
+        while True:
+            try:
+                self.manager.connect()
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.1)
+        self.server = self.manager.server()
+
+    def __getattr__(self, attr):
+        return getattr(self.server, attr)
+
+    def close(self):
+        self.manager.shutdown()
+        self.manager.join()
+
+
+def rate(func, n):
+    t0 = time.time()
+    func(n)
+    return n/(time.time()-t0)
+
+def sync(proc, method, *args):
+    def run(n):
+        for i in range(n):
+            getattr(proc, method)(*args)
+    return run
+
+def pipelined(proc, method, *args):
+    def run(n):
+        futures = [proc.call_async(method, *args) for i in range(n)]
+        for f in futures:
+            f.result()
+    return run
+
+def batched(proc, method, *args):
+    def run(n):
+        for i in range(0, n, BATCH):
+            with proc.batch() as batch:
+                for j in range(BATCH):
+                    getattr(batch, method)(*args)
+    return run
+
+
+if __name__ == "__main__":
+    frame = np.random.randint(0, 255, FRAME_SHAPE, dtype=np.uint8)
+    t0 = time.time()
+    legacy = LegacyProcessify(Worker, 56590)
+    print(f"legacy startup: {(time.time()-t0)*1000:.0f} ms")
+    t0 = time.time()
+    proc = Processify(Worker, socket=56591)
+    print(f"startup: {(time.time()-t0)*1000:.0f} ms")
+
+    print(f"small calls: legacy {rate(sync(legacy, 'nop'), CALLS):.0f}/s, sync {rate(sync(proc, 'nop'), CALLS):.0f}/s, "
+        f"call_async {rate(pipelined(proc, 'nop'), CALLS):.0f}/s, batch({BATCH}) {rate(batched(proc, 'nop'), CALLS):.0f}/s")
+    print(f"frame calls: legacy {rate(sync(legacy, 'mean', frame), FRAME_CALLS):.1f}/s, sync {rate(sync(proc, 'mean', frame), FRAME_CALLS):.1f}/s, "
+        f"call_async {rate(pipelined(proc, 'mean', frame), FRAME_CALLS):.1f}/s")
+
+    legacy.close()
+    proc.close()
@@ -0,0 +1,92 @@
+#
+# This file is part of Kritter
+#
+# All Kritter source code is provided under the terms of the
+# GNU General Public License v2 (http://www.gnu.org/licenses/gpl-2.0.html).
+# Those wishing to use Kritter source code, software and/or
+# technologies under different licensing terms should contact us at
+# support@charmedlabs.com.
+#
+
+import os
+import time
+import shutil
+import tempfile
+from threading import Lock
+from kritter.kstoremedia import KstoreMedia
+from kritter.savemediaqueue import SaveMediaQueue
+
+'''
+Benchmark of SaveMediaQueue uploads against a local stand-in store (no
+network), comparing 1 upload worker with several, with "oldest" and "newest"
+priority.  One file fails FAILURES times before it succeeds, to show the
+exponential backoff between attempts.  The queue's stats() (backlog,
+throughput) are printed while it drains.
+'''
+
+FILES = 20
+UPLOAD_TIME = 0.2
+WORKERS = 4
+FAILURES = 2
+
+
+# Stand-in for GPstoreMedia -- "uploads" take UPLOAD_TIME and the given file
+# fails the first FAILURES times.
+class LocalStoreMedia(KstoreMedia):
+    def __init__(self, fail=None):
+        super().__init__()
+        self.fail = fail
+        self.lock = Lock()
+        self.order = []
+        self.times = []
+        self.attempts = {}
+        self.active = self.max_active = 0
+
+    def store_image_file(self, filename, album="", desc="", data={}):
+        file = os.path.basename(filename)
+        with self.lock:
+            self.attempts.setdefault(file, []).append(time.time())
+            self.active += 1
+            self.max_active = max(self.active, self.max_active)
+        time.sleep(UPLOAD_TIME)
+        with self.lock:
+            self.active -= 1
+            if file==self.fail and len(self.attempts[file])<=FAILURES:
+                raise RuntimeError(f"{file} failed")
+            self.order.append(file)
+            self.times.append(time.time())
+        return f"file://{filename}"
+
+
+def run(workers, priority):
+    path = tempfile.mkdtemp()
+    files = [f"2026_01_01_00_00_{i:02d}.jpg" for i in range(FILES)]
+    for file in files:
+        open(os.path.join(path, file), "w").close()
+    store = LocalStoreMedia(fail=files[FILES//2])
+    t0 = time.time()
+    queue = SaveMediaQueue(store, path, keep=FILES, keep_uploaded=FILES, workers=workers, priority=priority)
+    while True:
+        time.sleep(1)
+        stats = queue.stats()
+        print(f"  {time.time()-t0:4.1f}s backlog {stats['backlog']}, uploading {stats['uploading']}, retrying {stats['retrying']}, "
+            f"throughput {stats['throughput']*60:.0f}/min")
+        if stats['backlog']==0 and stats['uploading']==0 and stats['committing']==0:
+            break
+    elapsed = time.time()-t0
+    queue.close()
+    shutil.rmtree(path)
+
+    # Time for the files that didn't fail, which isn't held up by backoff
+    ok = [t for f, t in zip(store.order, store.times) if f!=store.fail][-1]-t0
+    attempts = store.attempts[store.fail]
+    delays = [f"{b-a:.1f}s" for a, b in zip(attempts, attempts[1:])]
+    first = [int(f[17:19]) for f in store.order[0:5]]
+    print(f"workers {workers}, {priority}: {FILES-1} files in {ok:.1f}s, all in {elapsed:.1f}s, max concurrent {store.max_active}, "
+        f"first uploaded {first}, retry delays {delays}, uploaded {stats['uploaded']}, failed {stats['failed']}")
+
+
+if __name__ == "__main__":
+    run(1, "oldest")
+    run(WORKERS, "oldest")
+    run(WORKERS, "newest")
@@ -18,6 +18,8 @@ os.environ['LIBCAMERA_IPA_MODULE_PATH'] = _basepath
 
 from .about import __version__
 from .util import file_in_path, set_logger_level, get_color, file_extension, file_basename, valid_image_name, valid_video_name, valid_media_name, temp_file, date_stamped_file, time_stamped_file, load_metadata, get_metadata_filename, save_metadata, JSONEncodeFromNumpy, JSONDecodeToNumpy, Range, deep_update, FuncTimer, CalcDaytime
+from .profiler import Profiler
+from .framepool import FramePool, FrameRef
 from .camera import Camera 
 from .kencoder import Encoder
 from .streamer import Streamer
@@ -38,7 +40,8 @@ from .koverlay import Koverlay, OVERLAY_WIDTH_HEIGHT
 from .kimage import Kimage
 from .klogin import Klogin, PMASK_MAX, PMASK_MIN
 from .execterm import ExecTerm
-from .kimagedetector import KimageDetector, render_detected, render_detected_box, render_detected_image, render_detected_box_image, KimageDetectorThread
+from .kimagedetector import KimageDetector, render_detected, render_detected_box, render_detected_image, render_detected_box_image, KimageDetectorThread, DetectorResult, DetectionInterpolator, MotionGatedDetector, Detections
+from .kimagedetectorpool import KimageDetectorPool, PooledDetector
 from .processify import Processify
 from .kimageclassifier import KimageClassifier
 from .detectiontracker import DetectionTracker
@@ -11,25 +11,48 @@
 import cv2
 import time
 import numpy as np
+from kritter.kimagedetector import Detections
 
+# Crops are scored for sharpness after being downscaled so that their 
+# largest dimension is no more than this.  
+SHARPNESS_SIZE = 64
+
+# DetectionPicker keeps the "best" picture (largest and sharpest) of each 
+# tracked object and returns it when the object is deregistered or times out.
+# Each object is scored at most rate times per second (None for every frame).
+# By default the whole frame is returned with the det's box in frame 
+# coordinates.  If padding is not None (e.g. 0.25), only the object's crop, 
+# padded by padding times the box size on each side, is stored instead.  The
+# returned det's box is then relative to the crop, and det['offset'] is the 
+# crop's position in the frame.  max_bytes caps the memory used by the stored
+# crops -- the lowest-value crops are dropped when it's exceeded.  
 class DetectionPicker:
-    def __init__(self, timeout=10):
+    def __init__(self, timeout=10, rate=None, padding=None, max_bytes=None):
         self.timeout = timeout
+        self.rate = rate
+        self.padding = padding
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        # info[k] = [value, det, image, t, scored]
         self.info = {}
 
-    def _value(self, det, image):
-        # If score0 is in det, it means the the current frame has object in it.  
+    def _value(self, dets, row, image):
+        # If the object is matched, it means the the current frame has object in it.  
         # We only want to consider pictures with detected object in it, not
         # pictures where object has disappeared (for example).
-        if 'score0' in det:
+        if dets.matched is not None and dets.matched[row]:
             try:
-                box = det['box']
+                box = np.maximum(dets.boxes[row], 0)
                 area = (box[2]-box[0])*(box[3]-box[1])
                 # Crop object out of image
-                box = image[box[1]:box[3], box[0]:box[2], :]
+                box = image[box[1]:box[3], box[0]:box[2], 1]
                 # Calculate sharpness of image by calculating edges on green channel
-                # and averaging.
-                c = cv2.Canny(box[:, :, 1], 50, 250)
+                # and averaging.  Downscale first -- the edge density of the 
+                # downscaled crop is a good enough measure.  
+                scale = SHARPNESS_SIZE/max(box.shape)
+                if scale<1:
+                    box = cv2.resize(box, (max(int(box.shape[1]*scale), 1), max(int(box.shape[0]*scale), 1)), interpolation=cv2.INTER_AREA)
+                c = cv2.Canny(box, 50, 250)
                 sharpness = np.mean(c)
                 return area*sharpness
             except:
@@ -37,12 +60,51 @@ class DetectionPicker:
         
         return 0
 
+    def _picture(self, dets, row, image):
+        # Returns (image, det) to store for the given row.
+        det = dets.det(row)
+        if self.padding is None:
+            return image, det
+        box = dets.boxes[row]
+        pad = (self.padding*np.array([box[2]-box[0], box[3]-box[1]])).astype(int)
+        x0, y0 = np.maximum(box[0:2] - pad, 0).tolist()
+        x1, y1 = np.minimum(box[2:4] + pad, (image.shape[1], image.shape[0])).tolist()
+        # Copy so that we don't hold a reference to the whole frame.
+        crop = image[y0:y1, x0:x1].copy()
+        det['box'] = [det['box'][0]-x0, det['box'][1]-y0, det['box'][2]-x0, det['box'][3]-y0]
+        det['offset'] = [x0, y0]
+        return crop, det
+
+    def _store(self, info, value, picture):
+        image, det = picture
+        if self.padding is not None:
+            self.bytes += image.nbytes - (0 if info[2] is None else info[2].nbytes)
+        info[0:3] = [value, det, image]
+
+    def _release(self, info):
+        if self.padding is not None and info[2] is not None:
+            self.bytes -= info[2].nbytes
+        info[0] = 0
+        info[2] = None
+
+    def _evict(self):
+        # Drop the lowest-value pictures until we're under max_bytes.  The 
+        # objects stay registered, so they can pick up new pictures later.  
+        if self.max_bytes is None or self.bytes<=self.max_bytes:
+            return
+        for info in sorted((v for v in self.info.values() if v[2] is not None), key=lambda v: v[0]):
+            self._release(info)
+            if self.bytes<=self.max_bytes:
+                break
+
     def get_regs_deregs(self):
         return self.regs, self.deregs
 
     def update(self, image, dets):
         t = time.time()
 
+        # Accept DetectionTracker results as Detections or as a dictionary.
+        dets = Detections.from_list(dets)
         # Calculate registrations and deregistrations
         ikeys = set(self.info.keys())
         dkeys = set(dets.keys())
@@ -53,22 +115,25 @@ class DetectionPicker:
         deregs = ikeys-dkeys
         self.deregs = {i: self.info[i][1] for i in deregs}
 
-        for k, v in dets.items():
-            try:
-                if self.info[k][3]==0:
-                    continue
-            except:
-                pass
-            v['box'] = v['box'][0:4].tolist() # make list, get rid of extra bits
-            value = self._value(v, image)
-            try:
+        # Only score and store objects that are due.
+        for row, k in enumerate(dets.keys()):
+            info = self.info.get(k)
+            if info and info[3]==0:
+                continue
+            if info:
                 # Update class to most recent because it's the most accurate.
-                self.info[k][1]['class'] = v['class']
+                info[1]['class'] = dets.classes[row]
+                if self.rate and t-info[4]<1/self.rate:
+                    continue
+                info[4] = t
+                value = self._value(dets, row, image)
                 # If value exceeds current max, set info.
-                if value>self.info[k][0]:
-                    self.info[k][0:3] = [value, v, image]
-            except:
-                self.info[k] = [value, v, image, t]
+                if value>info[0] or info[2] is None:
+                    self._store(info, value, self._picture(dets, row, image))
+            else:
+                info = self.info[k] = [0, None, None, t, t]
+                self._store(info, self._value(dets, row, image), self._picture(dets, row, image))
+        self._evict()
 
         # Determine which objects have timed-out, if any.
         timeouts = []
@@ -80,11 +145,14 @@ class DetectionPicker:
         res = []
         # Go through deregistered objects, add to result, but only if it wasn't a timeout
         for i in deregs:
-            if self.info[i][3]!=0: # If i isn't a timeout
+            if self.info[i][3]!=0 and self.info[i][2] is not None: # If i isn't a timeout
                 res.append((self.info[i][2], self.info[i][1]))
+            self._release(self.info[i])
             del self.info[i]
-        # Go through timeouts, add to result
+        # Go through timeouts, add to result.  We no longer need the picture.
         for i in timeouts:
-            res.append((self.info[i][2], self.info[i][1]))
+            if self.info[i][2] is not None:
+                res.append((self.info[i][2], self.info[i][1]))
+            self._release(self.info[i])
 
         return res
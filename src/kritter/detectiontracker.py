@@ -11,8 +11,17 @@
 # This code was adapted from pyimagesearch.com.
 
 from scipy.spatial import distance as dist
-from collections import OrderedDict, defaultdict
+from scipy.optimize import linear_sum_assignment
 import numpy as np
+from kritter.kimagedetector import Detections
+
+# Cost of pairing an object and a detection that are too far apart to match
+INVALID_COST = 1e9
+# Initial number of track slots and class columns, both grow as needed
+TRACK_CAPACITY = 64
+CLASS_CAPACITY = 8
+# Per-track arrays, see DetectionTracker.__init__()
+TRACK_ARRAYS = ("ids", "boxes", "velocity", "steps", "disappeared", "matched", "class0", "score0", "histClass", "histScore", "histPos", "histLen", "classSums", "classCounts")
 
 def iou(boxA, boxB):
     # determine the (x, y)-coordinates of the intersection rectangle
@@ -33,18 +42,30 @@ def iou(boxA, boxB):
     # return the intersection over union value
     return iou  
 
+def iou_matrix(boxesA, boxesB):
+    # Vectorized version of iou() -- returns the IoU of every box in boxesA 
+    # with every box in boxesB as a len(boxesA) x len(boxesB) matrix.
+    boxesA = np.asarray(boxesA)[:, None, 0:4]
+    boxesB = np.asarray(boxesB)[None, :, 0:4]
+    xA = np.maximum(boxesA[..., 0], boxesB[..., 0])
+    yA = np.maximum(boxesA[..., 1], boxesB[..., 1])
+    xB = np.minimum(boxesA[..., 2], boxesB[..., 2])
+    yB = np.minimum(boxesA[..., 3], boxesB[..., 3])
+    interArea = np.maximum(0, xB - xA + 1) * np.maximum(0, yB - yA + 1)
+    boxAArea = (boxesA[..., 2] - boxesA[..., 0] + 1) * (boxesA[..., 3] - boxesA[..., 1] + 1)
+    boxBArea = (boxesB[..., 2] - boxesB[..., 0] + 1) * (boxesB[..., 3] - boxesB[..., 1] + 1)
+    return interArea / (boxAArea + boxBArea - interArea).astype(float)
+
 # Todo: make classSwitch a list of classes that are switchable.  This will require lots of changes
 # because we want to be able track unswitchable classes differently than switchable classes. 
 class DetectionTracker:
-    def __init__(self, maxDisappeared=1, maxDistance=250, maxClassHistory=100, threshold=0.5, iouEquiv=0.4, classSwitch=False):
-        # initialize the next unique object ID along with two ordered
-        # dictionaries used to keep track of mapping a given object
-        # ID to its centroid and number of consecutive frames it has
-        # been marked as "disappeared", respectively
+    def __init__(self, maxDisappeared=1, maxDistance=250, maxClassHistory=100, threshold=0.5, iouEquiv=0.4, classSwitch=False, predict=False, velocityGain=0.5, columns=False):
+        # initialize the next unique object ID.  Tracked objects are stored 
+        # as a structure of arrays -- row i of each array belongs to the 
+        # object with ID self.ids[i], and rows [0, self.n) are in use, in 
+        # order of registration.
         self.nextObjectID = 0
-        self.objects = OrderedDict()
-        self.disappeared = OrderedDict()
-        self.classHistory = OrderedDict()
+        self.n = 0
 
         # store the number of maximum consecutive frames a given
         # object is allowed to be marked as "disappeared" until we
@@ -63,132 +84,225 @@ class DetectionTracker:
         if not self.classSwitch:
             self.maxClassHistory = 1
 
+        # In predictive mode, each object has a constant-velocity motion 
+        # model.  Objects are matched against their predicted boxes, and
+        # coast() can be used to advance the objects between detections.
+        # velocityGain (0 to 1) determines how quickly the velocity 
+        # estimates respond to measurements.
+        self.predict = predict
+        self.velocityGain = velocityGain
+        # If columns is True, results are returned as Detections instead of 
+        # an {id: dict} dictionary.
+        self.columns = columns
+
+        # Class names are mapped to columns of the per-class sums.
+        self.classNames = []
+        self.classColumns = {}
+
+        # Boxes have a 5th column (class index) if we match based on class.
+        self.boxWidth = 4 if self.classSwitch else 5
+        self.ids = np.zeros(TRACK_CAPACITY, dtype=int)
+        self.boxes = np.zeros((TRACK_CAPACITY, self.boxWidth))
+        # Box velocity (pixels per step) and number of steps since the 
+        # object was last matched 
+        self.velocity = np.zeros((TRACK_CAPACITY, 4))
+        self.steps = np.zeros(TRACK_CAPACITY, dtype=int)
+        # Number of consecutive frames the object has been missing, negative 
+        # means that it's pre-registered.
+        self.disappeared = np.zeros(TRACK_CAPACITY, dtype=int)
+        # Class and score of the current frame's detection, if matched
+        self.matched = np.zeros(TRACK_CAPACITY, dtype=bool)
+        self.class0 = np.zeros(TRACK_CAPACITY, dtype=int)
+        self.score0 = np.zeros(TRACK_CAPACITY)
+        # Circular buffers of (class, score) history and running per-class 
+        # sums and counts over the history.
+        self.histClass = np.zeros((TRACK_CAPACITY, self.maxClassHistory), dtype=int)
+        self.histScore = np.zeros((TRACK_CAPACITY, self.maxClassHistory))
+        self.histPos = np.zeros(TRACK_CAPACITY, dtype=int)
+        self.histLen = np.zeros(TRACK_CAPACITY, dtype=int)
+        self.classSums = np.zeros((TRACK_CAPACITY, CLASS_CAPACITY))
+        self.classCounts = np.zeros((TRACK_CAPACITY, CLASS_CAPACITY), dtype=int)
+
+    def _grow(self):
+        # Double the number of track slots.
+        for attr in TRACK_ARRAYS:
+            array = getattr(self, attr)
+            setattr(self, attr, np.concatenate((array, np.zeros_like(array))))
+
+    def _classColumn(self, class_):
+        try:
+            return self.classColumns[class_]
+        except KeyError:
+            column = len(self.classNames)
+            if column==self.classSums.shape[1]:
+                self.classSums = np.hstack((self.classSums, np.zeros_like(self.classSums)))
+                self.classCounts = np.hstack((self.classCounts, np.zeros_like(self.classCounts)))
+            self.classNames.append(class_)
+            self.classColumns[class_] = column
+            return column
+
+    def _pushHistory(self, rows, classes, scores):
+        # Add (class, score) entries to the history of the given rows,
+        # retiring the oldest entries from the running sums if the 
+        # history is full.
+        pos = self.histPos[rows]
+        full = self.histLen[rows]==self.maxClassHistory
+        frows, fpos = rows[full], pos[full]
+        fclasses = self.histClass[frows, fpos]
+        self.classSums[frows, fclasses] -= self.histScore[frows, fpos]
+        self.classCounts[frows, fclasses] -= 1
+        self.histClass[rows, pos] = classes
+        self.histScore[rows, pos] = scores
+        self.classSums[rows, classes] += scores
+        self.classCounts[rows, classes] += 1
+        self.histPos[rows] = (pos + 1)%self.maxClassHistory
+        self.histLen[rows] = np.minimum(self.histLen[rows] + 1, self.maxClassHistory)
+
     def register(self, box, classScore):
         # Create new entry in object tables.
         # when registering an object we use the next available object
         # ID to store the box
-        self.objects[self.nextObjectID] = box
-        self.classHistory[self.nextObjectID] = [classScore]
-        self.disappeared[self.nextObjectID] = -self.maxDisappeared
+        if self.n==len(self.ids):
+            self._grow()
+        i = self.n
+        self.ids[i] = self.nextObjectID
+        self.boxes[i] = box
+        self.velocity[i] = 0
+        self.steps[i] = 0
+        self.disappeared[i] = -self.maxDisappeared
+        self.matched[i] = False
+        self.histPos[i] = self.histLen[i] = 0
+        self.classSums[i] = 0
+        self.classCounts[i] = 0
+        self._pushHistory(np.array([i]), np.array([self._classColumn(classScore[0])]), np.array([classScore[1]]))
+        self.n += 1
         self.nextObjectID += 1
 
+    def _remove(self, remove):
+        # Remove the rows flagged in remove (boolean array of length self.n) 
+        # while keeping the remaining rows in registration order.
+        if not remove.any():
+            return
+        keep = np.nonzero(~remove)[0]
+        n = len(keep)
+        for attr in TRACK_ARRAYS:
+            array = getattr(self, attr)
+            array[0:n] = array[keep]
+        self.n = n
+
     def deregister(self, objectID):
-        # to deregister an object ID we delete the object ID from
-        # both of our respective dictionaries
-        del self.objects[objectID]
-        del self.classHistory[objectID]
-        del self.disappeared[objectID]
-
-    def mostLikelyClass(self, history):
-        histogram = defaultdict(lambda: np.array([0.0, 0.0]))
-        for h in history:
-            histogram[h[0]] += np.array([h[1], 1.0])
-        max_ = [0.0, 1.0]
-        for k, v in histogram.items():
-            if v[0]>max_[0]:
-                max_ = v 
-                class_ = k 
-        return class_, max_[0]/max_[1] 
+        # to deregister an object ID we delete the object ID's row
+        self._remove(self.ids[0:self.n]==objectID)
 
     def removeOverlaps(self):
-        ious = {}
-        deregs = set()
-        for i in self.objects:
-            for j in self.objects:
-                if i==j:
-                    break
-                ious[(i, j)] = iou(self.objects[i], self.objects[j])
-            if i==j:
-                continue
-        ious = {k: v for k, v in sorted(ious.items(), key=lambda item: item[1], reverse=True)}
-        for k, v in ious.items():
-            if v>=self.iouEquiv:
-                i, j = k
-                if self.classSwitch:
-                    if len(self.classHistory[i])>len(self.classHistory[j]):
-                        deregs.add(j)
-                    else:
-                        deregs.add(i)
-                else:
-                    if self.classHistory[i][0][0]==self.classHistory[j][0][0]:
-                        if self.classHistory[i][0][1]>self.classHistory[j][0][1]:
-                            deregs.add(j)
-                        else:
-                            deregs.add(i)
-            else: # v<self.iouEquiv, which means no more left
-                break
-        for d in deregs:
-            self.deregister(d)
+        n = self.n
+        if n<2:
+            return
+        ious = iou_matrix(self.boxes[0:n], self.boxes[0:n])
+        # Consider each pair once, (i, j) where j was registered before i. 
+        i, j = np.nonzero(np.tril(ious>=self.iouEquiv, -1))
+        if len(i)==0:
+            return
+        # Each pair's decision doesn't depend on the other pairs, so we can 
+        # make all of them at once.
+        if self.classSwitch:
+            lengths = self.histLen[0:n]
+            deregs = np.where(lengths[i]>lengths[j], j, i)
+        else:
+            # The history is only one deep, so it's the most recent class and score.
+            classes = self.histClass[0:n, 0]
+            scores = self.histScore[0:n, 0]
+            same = classes[i]==classes[j]
+            i, j = i[same], j[same]
+            deregs = np.where(scores[i]>scores[j], j, i)
+        remove = np.zeros(n, dtype=bool)
+        remove[deregs] = True
+        self._remove(remove)
+
+    def match(self, D):
+        # Find the assignment of objects (rows) to input detections (columns) 
+        # that minimizes the total distance, then toss out any pairs that are 
+        # too far apart to be the same object.
+        C = np.where(D>self.maxDistance, INVALID_COST, D)
+        rows, cols = linear_sum_assignment(C)
+        valid = D[rows, cols]<=self.maxDistance
+        return rows[valid], cols[valid]
 
     def mostLikelyState(self, showDisappeared):
-        objects = {}
-        for obj in self.objects:
-            if self.disappeared[obj]>=0 and (showDisappeared or self.disappeared[obj]==0):
-                classScore = self.mostLikelyClass(self.classHistory[obj])
-                objInfo = {"box": self.objects[obj], "class": classScore[0], "score": classScore[1]}
-                try:
-                    classScore0 = self.classScore0[obj]
-                    objInfo['class0'] = classScore0[0]
-                    objInfo['score0'] = classScore0[1]
-                except: 
-                    pass
-                objects[obj] = objInfo
-
-
-        return objects
+        n = self.n
+        disappeared = self.disappeared[0:n]
+        if showDisappeared:
+            rows = np.nonzero(disappeared>=0)[0]
+        else:
+            rows = np.nonzero(disappeared==0)[0]
+        if len(rows)==0:
+            return Detections(ids=[]) if self.columns else {}
+        # The most likely class is the one with the highest summed score 
+        # over the history, and its score is the average.
+        sums = self.classSums[rows, 0:len(self.classNames)]
+        classes = sums.argmax(axis=1)
+        scores = sums[np.arange(len(rows)), classes]/np.maximum(self.classCounts[rows, classes], 1)
+        names = self.classNames
+        dets = Detections(self.boxes[rows, 0:4], scores, [names[c] for c in classes], ids=self.ids[rows], matched=self.matched[rows], class0=[names[c] for c in self.class0[rows]], score0=self.score0[rows])
+        return dets if self.columns else dets.todict()
+
+    def _advance(self):
+        # Move all objects one step along their predicted paths.
+        if self.predict:
+            self.boxes[0:self.n, 0:4] += self.velocity[0:self.n]
+            self.steps[0:self.n] += 1
+
+    def coast(self, showDisappeared=False):
+        # Advance objects without new detections, for example on frames where 
+        # the detector doesn't run.  Objects aren't marked as disappeared.
+        self.matched[0:self.n] = False
+        self._advance()
+        return self.mostLikelyState(showDisappeared)
 
     def update(self, dets, showDisappeared=False):
-        self.classScore0 = {}
+        self.matched[0:self.n] = False
+        self._advance()
         # check to see if the list of input bounding box rectangles
         # is empty      
         if len(dets)==0:
-            # loop over any existing tracked objects and mark them
-            # as disappeared
-            for objectID in list(self.disappeared.keys()):
-                if self.disappeared[objectID]>=0:
-                    self.disappeared[objectID] += 1
-
-                # if we have reached a maximum number of consecutive
-                # frames where a given object has been marked as
-                # missing, or if we're pre-registered, deregister it
-                if self.disappeared[objectID]<0 or self.disappeared[objectID]>self.maxDisappeared:
-                    self.deregister(objectID)
+            # mark existing tracked objects as disappeared
+            disappeared = self.disappeared[0:self.n]
+            disappeared[disappeared>=0] += 1
+
+            # if we have reached a maximum number of consecutive
+            # frames where a given object has been marked as
+            # missing, or if we're pre-registered, deregister it
+            self._remove((disappeared<0) | (disappeared>self.maxDisappeared))
 
             # return early as there are no centroids or tracking info
             # to update
             return self.mostLikelyState(showDisappeared)
 
-        classScores = []
-        # initialize an array of input centroids for the current frame
-        if self.classSwitch:
-            inputBoxes = np.zeros((len(dets), 4), dtype=int)
-        else:
-            inputBoxes = np.zeros((len(dets), 5), dtype=int)
-
-        # loop over the bounding box rectangles
-        for i, det in enumerate(dets):
-            if self.classSwitch:
-                inputBoxes[i] = det['box']
-            else:
-                # use the bounding box coordinates to derive the centroid
-                # Add class index so we can use the class index to match between images.
-                # Use 10000 multiplier because this exceeds all likely image resolutions 
-                # and distances within the image.  
-                inputBoxes[i] = det['box'] + [det['index']*10000]
-            classScores.append((det['class'], det['score']))
+        # Lists of detection dicts are converted, Detections are used as-is.
+        dets = Detections.from_list(dets)
+        # initialize an array of input boxes for the current frame
+        inputBoxes = np.zeros((len(dets), self.boxWidth), dtype=int)
+        inputBoxes[:, 0:4] = dets.boxes
+        if not self.classSwitch:
+            # use the bounding box coordinates to derive the centroid
+            # Add class index so we can use the class index to match between images.
+            # Use 10000 multiplier because this exceeds all likely image resolutions 
+            # and distances within the image.  
+            inputBoxes[:, 4] = dets.indexes*10000
+        inputClasses = np.array([self._classColumn(c) for c in dets.classes], dtype=int)
+        inputScores = dets.scores
         # if we are currently not tracking any objects take the input
         # centroids and register each of them
-        if len(self.objects) == 0:
+        if self.n == 0:
             for i in range(0, len(inputBoxes)):
-                if classScores[i][1]>=self.threshold:
-                    self.register(inputBoxes[i], classScores[i])
+                if inputScores[i]>=self.threshold:
+                    self.register(inputBoxes[i], (self.classNames[inputClasses[i]], inputScores[i]))
         # otherwise, are are currently tracking objects so we need to
         # try to match the input centroids to existing object
         # centroids
         else:
-            # grab the set of object IDs and corresponding centroids
-            objectIDs = list(self.objects.keys())
-            objectBoxes = np.array(list(self.objects.values()))
+            n = self.n
+            objectBoxes = self.boxes[0:n]
 
             # compute the distance between each pair of object
             # centroids and input centroids, respectively -- our
@@ -201,83 +315,43 @@ class DetectionTracker:
                 objectCentroids = np.vstack(((objectBoxes[:, 0] + objectBoxes[:, 2])/2, (objectBoxes[:, 1] + objectBoxes[:, 3])/2, objectBoxes[:, 4])).T
                 inputCentroids = np.vstack(((inputBoxes[:, 0] + inputBoxes[:, 2])/2, (inputBoxes[:, 1] + inputBoxes[:, 3])/2, inputBoxes[:, 4])).T
             D = dist.cdist(objectCentroids, inputCentroids)
-            # in order to perform this matching we must (1) find the
-            # smallest value in each row and then (2) sort the row
-            # indexes based on their minimum values so that the row
-            # with the smallest value as at the *front* of the index
-            # list
-            rows = D.min(axis=1).argsort()
-
-            # next, we perform a similar process on the columns by
-            # finding the smallest value in each column and then
-            # sorting using the previously computed row index list
-            cols = D.argmin(axis=1)[rows]
-
-            # in order to determine if we need to update, register,
-            # or deregister an object we need to keep track of which
-            # of the rows and column indexes we have already examined
-            usedRows = set()
-            usedCols = set()
-
-            # loop over the combination of the (row, column) index
-            # tuples
-            for (row, col) in zip(rows, cols):
-                # if we have already examined either the row or
-                # column value before, ignore it
-                if row in usedRows or col in usedCols:
-                    continue
-
-                # if the distance between centroids is greater than
-                # the maximum distance, do not associate the two
-                # centroids to the same object
-                if D[row, col] > self.maxDistance:
-                    continue
-
-                # otherwise, grab the object ID for the current row,
-                # set its new centroid, and reset the disappeared
-                # counter
-                objectID = objectIDs[row]
-                self.objects[objectID] = inputBoxes[col]
-                self.classScore0[objectID] = classScores[col]
-                self.classHistory[objectID].insert(0, classScores[col])
-                if len(self.classHistory[objectID])>self.maxClassHistory:
-                    self.classHistory[objectID] = self.classHistory[objectID][0:self.maxClassHistory]
-                if self.disappeared[objectID]<0:
-                    self.disappeared[objectID] += 1
-                else:
-                    self.disappeared[objectID] = 0
-                # indicate that we have examined each of the row and
-                # column indexes, respectively
-                usedRows.add(row)
-                usedCols.add(col)
-
-            # compute both the row and column index we have NOT yet
-            # examined
-            unusedRows = set(range(0, D.shape[0])).difference(usedRows)
-            unusedCols = set(range(0, D.shape[1])).difference(usedCols)
-
-            # we need to check and see if some of these objects have
-            # potentially disappeared
-            # loop over the unused row indexes
-            for row in unusedRows:
-                # grab the object ID for the corresponding row
-                # index and increment the disappeared counter
-                objectID = objectIDs[row]
-                if self.disappeared[objectID]>=0:
-                    self.disappeared[objectID] += 1
-
-                # check to see if the number of consecutive
-                # frames the object has been marked "disappeared"
-                # for warrants deregistering the object
-                if self.disappeared[objectID]<0 or self.disappeared[objectID]>self.maxDisappeared:
-                    self.deregister(objectID)
-
-            # if the number of input centroids is greater
-            # than the number of existing object centroids we need to
-            # register each new input centroid as a trackable object
-            for col in unusedCols:
-                if classScores[col][1]>=self.threshold:
-                    self.register(inputBoxes[col], classScores[col])
+            rows, cols = self.match(D)
+
+            # for the matched objects, set the new box, add the class 
+            # and score to the history, and reset the disappeared 
+            # counter
+            if self.predict:
+                # Correct the velocity based on how far off the prediction was
+                # (averaged over the steps since the last match).
+                residual = inputBoxes[cols, 0:4] - self.boxes[rows, 0:4]
+                self.velocity[rows] += self.velocityGain*residual/self.steps[rows, None]
+                self.steps[rows] = 0
+            self.boxes[rows] = inputBoxes[cols]
+            self.matched[rows] = True
+            self.class0[rows] = inputClasses[cols]
+            self.score0[rows] = inputScores[cols]
+            self._pushHistory(rows, inputClasses[cols], inputScores[cols])
+            disappeared = self.disappeared[rows]
+            self.disappeared[rows] = np.where(disappeared<0, disappeared + 1, 0)
+
+            # the objects we didn't match have potentially disappeared,
+            # so increment their disappeared counters
+            unusedRows = np.ones(n, dtype=bool)
+            unusedRows[rows] = False
+            disappeared = self.disappeared[0:n]
+            disappeared[unusedRows & (disappeared>=0)] += 1
+
+            # check to see if the number of consecutive
+            # frames the object has been marked "disappeared"
+            # for warrants deregistering the object
+            self._remove(unusedRows & ((disappeared<0) | (disappeared>self.maxDisappeared)))
+
+            # the input centroids we didn't match need to be registered 
+            # as new trackable objects
+            unusedCols = np.ones(len(inputBoxes), dtype=bool)
+            unusedCols[cols] = False
+            for col in np.nonzero(unusedCols & (inputScores>=self.threshold))[0]:
+                self.register(inputBoxes[col], (self.classNames[inputClasses[col]], inputScores[col]))
 
 
         self.removeOverlaps()
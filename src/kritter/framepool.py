@@ -0,0 +1,131 @@
+#
+# This file is part of Kritter
+#
+# All Kritter source code is provided under the terms of the
+# GNU General Public License v2 (http://www.gnu.org/licenses/gpl-2.0.html).
+# Those wishing to use Kritter source code, software and/or
+# technologies under different licensing terms should contact us at
+# support@charmedlabs.com.
+#
+
+import time
+import numpy as np
+from threading import RLock
+
+# Number of frame buffers in a FramePool
+FRAME_POOL_SIZE = 8
+
+
+# A reference to a frame in a FramePool.  frame is a read-only view of the
+# pool's buffer, which stays valid until release() is called.  Consumers that
+# hand the frame to another consumer (or thread) should call retain() and
+# give it the returned reference, so that each holder releases its own.
+# Kvideo.push_frame(), KimageDetectorThread.detect() and 
+# KstoreMedia.store_image_array() accept FrameRefs directly and take their own
+# references instead of copying.  Frames that they hand back to the caller 
+# (e.g. DetectorResult images) are read-only views, so copy them before 
+# drawing on them.  
+class FrameRef:
+    def __init__(self, pool, slot):
+        self.pool = pool
+        self.slot = slot
+        self.frame = pool.views[slot]
+        self.timestamp = pool.timestamps[slot]
+        self.index = pool.indexes[slot]
+        self.released = False
+
+    def retain(self):
+        return self.pool._ref(self.slot)
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.pool._release(self.slot)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def __del__(self):
+        # Safety net -- references should be released explicitly.
+        self.release()
+
+
+# Fixed ring of preallocated frame buffers shared by frame consumers (video
+# streaming, detection, picking, saving, etc.)  The producer (typically the
+# camera thread) calls put() for each frame.  Consumers call latest() to get a
+# reference to the newest frame, so slow consumers skip frames instead of
+# queuing them.  Buffers with references are never overwritten, and put()
+# never blocks -- if every buffer is referenced, the frame is dropped.
+class FramePool:
+    def __init__(self, shape, dtype=np.uint8, size=FRAME_POOL_SIZE):
+        self.buffers = np.zeros((size, *shape), dtype=dtype)
+        self.views = []
+        for buffer in self.buffers:
+            view = buffer.view()
+            view.flags.writeable = False
+            self.views.append(view)
+        self.timestamps = [0]*size
+        self.indexes = [0]*size
+        self.refs = np.zeros(size, dtype=int)
+        # Reentrant, because FrameRef.__del__ (garbage collection) can release
+        # a reference while this thread holds the lock.  
+        self.lock = RLock()
+        self.newest = None
+        self.next = 0
+        self.count = 0
+        self.drops = 0
+
+    def _free_slot(self):
+        # Returns the next unreferenced slot in ring order (oldest first), or
+        # None.  The newest frame is kept for latest().
+        size = len(self.buffers)
+        for i in range(size):
+            slot = (self.next + i)%size
+            if self.refs[slot]==0 and slot!=self.newest:
+                self.next = (slot + 1)%size
+                return slot
+        return None
+
+    def put(self, frame, timestamp=None, index=None):
+        # Copy frame into the pool.  Returns False if the frame was dropped.
+        if isinstance(frame, tuple):
+            frame, timestamp, index = frame[0:3]
+        with self.lock:
+            slot = self._free_slot()
+            if slot is None:
+                self.drops += 1
+                return False
+            # Reserve the slot while we copy outside of the lock.
+            self.refs[slot] += 1
+        np.copyto(self.buffers[slot], frame)
+        with self.lock:
+            self.timestamps[slot] = time.time() if timestamp is None else timestamp
+            self.indexes[slot] = self.count if index is None else index
+            self.count += 1
+            self.refs[slot] -= 1
+            self.newest = slot
+        return True
+
+    def latest(self):
+        # Returns a FrameRef of the newest frame, or None if there isn't one.
+        with self.lock:
+            if self.newest is None:
+                return None
+            self.refs[self.newest] += 1
+            return FrameRef(self, self.newest)
+
+    def _ref(self, slot):
+        with self.lock:
+            self.refs[slot] += 1
+            return FrameRef(self, slot)
+
+    def _release(self, slot):
+        with self.lock:
+            self.refs[slot] -= 1
+
+    def stats(self):
+        with self.lock:
+            return {"size": len(self.buffers), "frames": self.count, "drops": self.drops, "referenced": int(np.count_nonzero(self.refs))}
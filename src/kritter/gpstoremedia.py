@@ -11,21 +11,111 @@
 import os
 import json
 import pickle
+import mimetypes
+import time
+import threading
+from concurrent.futures import Future
 import requests
 from .kstoremedia import KstoreMedia
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+
+
+UPLOAD_URL = 'https://photoslibrary.googleapis.com/v1/uploads'
+# Resumable uploads are sent in chunks of (about) this many bytes 
+CHUNK_SIZE = 8*1024*1024
+ALBUMS_FILE = "gpstoremedia_albums.json"
+# Maximum number of media items per batchCreate call (API limit), and how 
+# long (seconds) items wait for others to join their batch
+BATCH_SIZE = 50
+BATCH_DELAY = 2
+# Cached album ids expire after this long (seconds)
+ALBUM_TTL = 24*60*60
+
+
+# Collects media items (uploaded bytes) and creates them in groups of up to 
+# BATCH_SIZE per album with one batchCreate call.  A group is committed when
+# it's full or when its oldest item has waited BATCH_DELAY seconds.  add() 
+# returns a Future that's set to the item's productUrl. 
+class _MediaItemBatcher:
+    def __init__(self, store):
+        self.store = store
+        self.groups = {}
+        self.cond = threading.Condition()
+        self.run_thread = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def add(self, album, item):
+        future = Future()
+        with self.cond:
+            group = self.groups.setdefault(album, [time.time(), []])
+            group[1].append((item, future))
+            self.cond.notify()
+        return future
+
+    def _next_group(self):
+        # Returns (album, items) of the group that's due, or None.
+        while self.run_thread or self.groups:
+            t = time.time()
+            timeout = None if not self.groups else BATCH_DELAY
+            for album, (t0, items) in self.groups.items():
+                if len(items)>=BATCH_SIZE or t-t0>=BATCH_DELAY or not self.run_thread:
+                    batch = items[0:BATCH_SIZE]
+                    if len(items)>BATCH_SIZE:
+                        self.groups[album] = [t, items[BATCH_SIZE:]]
+                    else:
+                        del self.groups[album]
+                    return album, batch
+                timeout = min(timeout, BATCH_DELAY-(t-t0))
+            self.cond.wait(timeout)
+        return None
+
+    def run(self):
+        while True:
+            with self.cond:
+                group = self._next_group()
+            if group is None:
+                break
+            self.commit(*group)
+
+    def commit(self, album, batch):
+        try:
+            results = self.store._create_media_items(self.store._service(), album, [item for item, future in batch])
+        except Exception as e:
+            for item, future in batch:
+                future.set_exception(e)
+            return
+        for (item, future), result in zip(batch, results):
+            try:
+                future.set_result(result['mediaItem']['productUrl'])
+            except KeyError:
+                future.set_exception(RuntimeError(result.get('status', {}).get('message', "unable to create media item")))
+
+    def close(self):
+        # Commit what we have and stop.
+        with self.cond:
+            self.run_thread = False
+            self.cond.notify()
+        self.thread.join()
 
 
 class GPstoreMedia(KstoreMedia):
 
-    def __init__(self, gcloud):
+    def __init__(self, gcloud, albums_file=None):
         super().__init__()
         self.gcloud = gcloud
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # Album title -> (id, time) cache, saved next to the credentials 
+        if albums_file is None:
+            albums_file = os.path.join(os.path.dirname(gcloud.auth_file), ALBUMS_FILE)
+        self.albums_file = albums_file
+        self.albums = self._load_albums()
+        self.batcher = None
 
     def _post_gphoto(self, filename):
-        f = open(filename, 'rb').read();
-
-        url = 'https://photoslibrary.googleapis.com/v1/uploads'
+        url = UPLOAD_URL
         headers = {
             'Authorization': "Bearer " + self.gcloud.creds().token,
             'Content-Type': 'application/octet-stream',
@@ -33,75 +123,211 @@ class GPstoreMedia(KstoreMedia):
             'X-Goog-Upload-Protocol': "raw",
         }
 
-        r = requests.post(url, data=f, headers=headers)
+        # Pass the file object so that the file is streamed rather than read 
+        # into memory.  
+        with open(filename, 'rb') as f:
+            r = requests.post(url, data=f, headers=headers)
         return r.content
 
+    def _post_gphoto_resumable(self, filename, state, save_state=None):
+        # Resumable upload protocol -- start a session, which gives us an 
+        # upload URL, then send chunks to it.  state holds the URL and offset,
+        # so we can query the server and pick up where we left off. 
+        size = os.path.getsize(filename)
+        auth = {'Authorization': "Bearer " + self.gcloud.creds().token}
+        offset = None
+        if state.get('url'):
+            r = requests.post(state['url'], headers={**auth, 'X-Goog-Upload-Command': "query"})
+            if r.ok and r.headers.get('X-Goog-Upload-Status')=="active":
+                offset = int(r.headers['X-Goog-Upload-Size-Received'])
+        if offset is None:
+            headers = {
+                **auth,
+                'Content-Length': "0",
+                'X-Goog-Upload-Command': "start",
+                'X-Goog-Upload-Content-Type': mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+                'X-Goog-Upload-File-Name': os.path.basename(filename),
+                'X-Goog-Upload-Protocol': "resumable",
+                'X-Goog-Upload-Raw-Size': str(size),
+            }
+            r = requests.post(UPLOAD_URL, headers=headers)
+            r.raise_for_status()
+            granularity = int(r.headers.get('X-Goog-Upload-Chunk-Granularity', 1))
+            state.clear()
+            state.update({'url': r.headers['X-Goog-Upload-URL'], 'chunk': max(CHUNK_SIZE//granularity, 1)*granularity})
+            offset = 0
+        state['offset'] = offset
+        if save_state:
+            save_state(state)
 
-    def store_image_file(self, filename, album="", desc="", data={}):
-        service = build('photoslibrary', 'v1', credentials=self.gcloud.creds(), static_discovery=False)
+        # Only one chunk is in memory at a time.  
+        with open(filename, 'rb') as f:
+            while True:
+                f.seek(offset)
+                chunk = f.read(state['chunk'])
+                last = offset + len(chunk)>=size
+                headers = {
+                    **auth, 
+                    'X-Goog-Upload-Command': "upload, finalize" if last else "upload",
+                    'X-Goog-Upload-Offset': str(offset),
+                }
+                r = requests.post(state['url'], data=chunk, headers=headers)
+                r.raise_for_status()
+                if last:
+                    return r.content
+                offset += len(chunk)
+                state['offset'] = offset
+                if save_state:
+                    save_state(state)
 
-        album_id = None
-        if album:
-            try:
-                albums = service.sharedAlbums().list().execute()
-                albums = albums['sharedAlbums']
-                for a in albums:
-                    if 'title' in a and a['title']==album:
-                        album_id = a['id']
-                        break
-            except:
-                pass
-            if album_id is None:
+    def _service(self):
+        # Service discovery is expensive, so build the service once per 
+        # credential (token) refresh.  Services aren't thread-safe, so each 
+        # thread gets its own.  
+        creds = self.gcloud.creds()
+        token = creds.token if creds else None
+        if getattr(self.local, 'token', None)!=token or getattr(self.local, 'service', None) is None:
+            self.local.service = build('photoslibrary', 'v1', credentials=creds, static_discovery=False)
+            self.local.token = token
+        return self.local.service
+
+    def _load_albums(self):
+        try:
+            with open(self.albums_file) as file:
+                return {k: tuple(v) for k, v in json.load(file).items()}
+        except:
+            return {}
+
+    def _save_albums(self):
+        try:
+            with open(self.albums_file, 'w') as file:
+                json.dump(self.albums, file)
+        except:
+            pass
+
+    def _list_albums(self, service):
+        # Map all album titles to ids with as few requests as possible (one 
+        # per page).  Owned albums take precedence over shared albums.
+        albums = {}
+        for g_album, entry in [(service.sharedAlbums, 'sharedAlbums'), (service.albums, 'albums')]:
+            token = None
+            while True:
                 try:
-                    albums = service.albums().list().execute()
-                    albums = albums['albums']
-                    for a in albums:
-                        if 'title' in a and a['title']==album:
-                            album_id = a['id']
-                            break
+                    res = g_album().list(pageSize=50, pageToken=token).execute()
                 except:
-                    pass
+                    break
+                for a in res.get(entry, []):
+                    if 'title' in a:
+                        albums[a['title']] = a['id']
+                token = res.get('nextPageToken')
+                if not token:
+                    break
+        return albums
+
+    def _album_id(self, service, album, create=True):
+        # Album ids are cached (and saved to disk) for ALBUM_TTL seconds, so 
+        # most uploads don't need to look up the album.  
+        if not album:
+            return None
+        t = time.time()
+        with self.lock:
+            try:
+                album_id, t0 = self.albums[album]
+                if t-t0<ALBUM_TTL:
+                    return album_id
+            except KeyError:
+                pass
+            # Refresh all titles while we're at it.
+            albums = self._list_albums(service)
+            self.albums.update({k: (v, t) for k, v in albums.items()})
+            album_id = albums.get(album)
             # new album
-            if album_id==None:
-                try:
-                    response = service.albums().create(body={'album': {'title': album}}).execute()
-                    album_id = response['id']
-                except:
-                    pass
+            if album_id is None:
+                self.albums.pop(album, None)
+                if create:
+                    try:
+                        response = service.albums().create(body={'album': {'title': album}}).execute()
+                        album_id = response['id']
+                        self.albums[album] = album_id, t
+                    except:
+                        pass
+            self._save_albums()
+        return album_id
 
-        # Call the Drive v3 API
-        upload_token = self._post_gphoto(filename)
+    def _invalidate_album(self, album):
+        with self.lock:
+            if self.albums.pop(album, None):
+                self._save_albums()
+
+    def _media_item(self, upload_token, desc="", data={}):
         # If we want to save data with picture instead of just a description string, 
         # turn description string into a json string and add desc (if needed).
         if data:
             if desc:
                 data['desc'] = desc
             desc = json.dumps(data)
-        body = {
-            'album_id': album_id, 
-            'newMediaItems': [
-                {
-                    "description": desc,
-                    "simpleMediaItem": 
-                    {
-                        "uploadToken": upload_token.decode('UTF-8')
-                    }
-                }
-            ]
+        return {
+            "description": desc,
+            "simpleMediaItem": 
+            {
+                "uploadToken": upload_token.decode('UTF-8')
+            }
         }
-        # remove entry if no album
-        if album_id==None:
-            body.pop('album_id')
 
-        results = service.mediaItems().batchCreate(body=body).execute()
-        return results['newMediaItemResults'][0]['mediaItem']['productUrl']
+    def _create_media_items(self, service, album, items):
+        # Add up to BATCH_SIZE media items in one batchCreate call.  Returns 
+        # the newMediaItemResults, which are in the same order as items.
+        def create():
+            body = {'album_id': self._album_id(service, album), 'newMediaItems': items}
+            # remove entry if no album
+            if body['album_id']==None:
+                body.pop('album_id')
+            return service.mediaItems().batchCreate(body=body).execute()['newMediaItemResults']
+        try:
+            return create()
+        except HttpError as e:
+            # The cached album may have been deleted (400 or 404), so look it 
+            # up again.  Other errors (quota, server) aren't the album's fault.
+            # (The upload tokens can be used until they succeed.) 
+            if not album or e.resp.status not in (400, 404):
+                raise
+            self._invalidate_album(album)
+            return create()
+
+    def _store(self, upload_token, album, desc, data):
+        results = self._create_media_items(self._service(), album, [self._media_item(upload_token, desc, data)])
+        return results[0]['mediaItem']['productUrl']
+
+    def store_image_file(self, filename, album="", desc="", data={}):
+        # Call the Drive v3 API
+        upload_token = self._post_gphoto(filename)
+        return self._store(upload_token, album, desc, data)
+
+    def store_image_file_async(self, filename, album="", desc="", data={}):
+        # The bytes are uploaded here (in the caller's thread), and the media
+        # item is created along with others in the same album by the batcher.
+        upload_token = self._post_gphoto(filename)
+        with self.lock:
+            if self.batcher is None:
+                self.batcher = _MediaItemBatcher(self)
+        return self.batcher.add(album, self._media_item(upload_token, desc, data))
+
+    def close(self):
+        if self.batcher:
+            self.batcher.close()
+            self.batcher = None
+
+    def store_video_file(self, filename, album="", desc="", data={}, thumbnail=None):
+        return self.store_video_file_resumable(filename, album, desc, data)
 
-    def store_video_file(self, filename, album="", desc="", data={}):
-        # Google Photos accepts videos through the same API path as images.
-        return self.store_image_file(filename, album, desc)
+    def store_video_file_resumable(self, filename, album="", desc="", data={}, state=None, save_state=None):
+        # Google Photos accepts videos through the same API path as images, 
+        # but we upload them in chunks.
+        upload_token = self._post_gphoto_resumable(filename, {} if state is None else state, save_state)
+        return self._store(upload_token, album, desc, data)
 
     def _retrieve_helper(self, id, count, dest_path, callback_func=None):
-        service = build('photoslibrary', 'v1', credentials=self.gcloud.creds(), static_discovery=False)
+        service = self._service()
         token = None
         body = {'albumId': id}
         j = 1
@@ -126,46 +352,36 @@ class GPstoreMedia(KstoreMedia):
 
 
     def retrieve_album(self, album, dest_path, callback_func=None):
-        service = build('photoslibrary', 'v1', credentials=self.gcloud.creds(), static_discovery=False)
-        found = False
-        token = None
-        for g_album, entry in [(service.sharedAlbums, 'sharedAlbums'), (service.albums, 'albums')]:
-            while True:
-                res = g_album().list(pageToken=token).execute()
-                try:
-                    for i in res[entry]:
-                        if i['title']==album:
-                            found = True
-                            self._retrieve_helper(i['id'], i['mediaItemsCount'], dest_path, callback_func)
-                except KeyError:
-                    pass
-                try:
-                    token = res['nextPageToken']
-                except KeyError:
-                    break
-        return found
+        service = self._service()
+        album_id = self._album_id(service, album, create=False)
+        if album_id is None:
+            return False
+        try:
+            count = service.albums().get(albumId=album_id).execute().get('mediaItemsCount', 0)
+        except HttpError:
+            self._invalidate_album(album)
+            return False
+        self._retrieve_helper(album_id, count, dest_path, callback_func)
+        return True
                 
     def get_share_url(self, album):
-        service = build('photoslibrary', 'v1', credentials=self.gcloud.creds(), static_discovery=False)
-        album_id = None
+        service = self._service()
         try:
-            albums = service.albums().list().execute()
-            albums = albums['albums']
-            for a in albums:
-                if 'title' in a and a['title'] == album:
-                    album_id = a['id']
-                    request_body = {
-                        'sharedAlbumOptions': {
-                            'isCollaborative': False,
-                            'isCommentable': False
-                        }  
-                    }
-                    try: # try sharing album
-                        response = service.albums().share(albumId=album_id,body=request_body).execute()
-                        return response['shareInfo']['shareableUrl']
-                    except:
-                        # if album is already shared, just get url
-                        return service.albums().get(albumId = album_id).execute()['shareInfo']['shareableUrl']
-        # if album by that name not found return none
+            album_id = self._album_id(service, album, create=False)
+            # if album by that name not found return none
+            if album_id is None:
+                return None
+            request_body = {
+                'sharedAlbumOptions': {
+                    'isCollaborative': False,
+                    'isCommentable': False
+                }  
+            }
+            try: # try sharing album
+                response = service.albums().share(albumId=album_id,body=request_body).execute()
+                return response['shareInfo']['shareableUrl']
+            except:
+                # if album is already shared, just get url
+                return service.albums().get(albumId = album_id).execute()['shareInfo']['shareableUrl']
         except: 
             return None
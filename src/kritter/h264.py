@@ -12,10 +12,12 @@ import fractions
 import logging
 import math
 import time
-from struct import pack, unpack_from
+from struct import pack_into
 from typing import Iterator, List, Tuple
 import kritter
 import cv2
+import numpy
+from .profiler import Profiler
 
 logger = logging.getLogger(__name__)
 from .util import set_logger_level
@@ -30,21 +32,128 @@ PACKET_MAX = 1300
 
 NAL_TYPE_FU_A = 28
 NAL_TYPE_STAP_A = 24
+NAL_TYPE_IDR = 5
 
 NAL_HEADER_SIZE = 1
 FU_A_HEADER_SIZE = 2
 LENGTH_FIELD_SIZE = 2
 STAP_A_HEADER_SIZE = NAL_HEADER_SIZE + LENGTH_FIELD_SIZE
 
+START_CODE = b'\x00\x00\x01'
+
+# Supported frame formats.  I420 and NV12 frames are single-channel arrays with 
+# the chroma plane(s) below the luma plane, i.e. (height*3/2, width), same as 
+# what cv2.cvtColor(frame, cv2.COLOR_BGR2YUV_I420) produces.
+FORMATS = ("BGR24", "I420", "NV12")
+
+FRAME_BUFFER_SIZE = 0x10000 # initial size of packet buffers, grows as needed
+
+
+def _exported(buf):
+    # A bytearray can't be resized while memoryviews of it exist. 
+    try:
+        buf.append(0)
+    except BufferError:
+        return True
+    del buf[-1]
+    return False
+
+
+def frame_resolution(frame, format="BGR24"):
+    if format=="BGR24":
+        return frame.shape[1], frame.shape[0]
+    return frame.shape[1], frame.shape[0]*2//3
+
+
+def convert_to_i420(frame, format="BGR24", resolution=None):
+    """
+    Convert frame to I420 (what the encoder consumes), resizing it to 
+    resolution along the way if needed.  I420 frames that are already 
+    the right size are returned as-is. 
+    """
+    if format not in FORMATS:
+        raise RuntimeError(f"Unsupported frame format {format}")
+    src_resolution = frame_resolution(frame, format)
+    if resolution is None:
+        resolution = src_resolution
+    if format=="BGR24":
+        # Resize first so we only convert the pixels we keep.
+        if resolution!=src_resolution:
+            frame = cv2.resize(frame, resolution, interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(frame, cv2.COLOR_BGR2YUV_I420)
+    if format=="I420" and resolution==src_resolution:
+        return frame
+
+    # Resize the planes directly into the I420 output buffer.  For NV12, the 
+    # interleaved chroma plane is resized as a 2-channel image and then 
+    # split into the U and V planes.
+    sw, sh = src_resolution
+    w, h = resolution
+    res = numpy.empty((h*3//2, w), dtype=numpy.uint8)
+    out = res.reshape(-1)
+    y = out[:w*h].reshape(h, w)
+    u = out[w*h:w*h*5//4].reshape(h//2, w//2)
+    v = out[w*h*5//4:].reshape(h//2, w//2)
+    src = frame.reshape(-1)
+    sy = src[:sw*sh].reshape(sh, sw)
+    if format=="I420":
+        su = src[sw*sh:sw*sh*5//4].reshape(sh//2, sw//2)
+        sv = src[sw*sh*5//4:sw*sh*3//2].reshape(sh//2, sw//2)
+        cv2.resize(sy, (w, h), dst=y, interpolation=cv2.INTER_AREA)
+        cv2.resize(su, (w//2, h//2), dst=u, interpolation=cv2.INTER_AREA)
+        cv2.resize(sv, (w//2, h//2), dst=v, interpolation=cv2.INTER_AREA)
+    else: # NV12
+        suv = src[sw*sh:sw*sh*3//2].reshape(sh//2, sw//2, 2)
+        if resolution==src_resolution:
+            y[:] = sy
+        else:
+            cv2.resize(sy, (w, h), dst=y, interpolation=cv2.INTER_AREA)
+            suv = cv2.resize(suv, (w//2, h//2), interpolation=cv2.INTER_AREA)
+        u[:] = suv[:, :, 0]
+        v[:] = suv[:, :, 1]
+    return res
+
+
+# Packets are written into bytearrays from this pool and handed to aiortc as 
+# memoryviews.  A buffer is only reused after all of its memoryviews have been 
+# released, which includes aiortc's RTX history, so in steady state the pool 
+# stays at a constant number of buffers.
+class BufferPool:
+    def __init__(self, size=FRAME_BUFFER_SIZE):
+        self.size = size
+        self.buffers = []
+
+    def get(self, size):
+        free = None
+        for i, buf in enumerate(self.buffers):
+            if not _exported(buf):
+                if len(buf)>=size:
+                    return buf
+                free = i
+        # Grow geometrically so that a larger keyframe doesn't trigger 
+        # reallocation every time.
+        while self.size<size:
+            self.size *= 2
+        buf = bytearray(self.size)
+        if free is None:
+            self.buffers.append(buf)
+        else: # Replace the free, but too small buffer. 
+            self.buffers[free] = buf
+        return buf
+
 
 class H264Encoder:
-    def __init__(self, resolution=DEFAULT_RESOLUTION, bitrate=DEFAULT_BITRATE) -> None:
+    def __init__(self, resolution=DEFAULT_RESOLUTION, bitrate=DEFAULT_BITRATE, profiler=None) -> None:
         self.codec = None
+        self.profiler = profiler if profiler else Profiler()
         self.__target_bitrate = bitrate
         self.resolution = resolution
+        self.pool = BufferPool()
+        # True if the last encoded frame is a keyframe (IDR)
+        self.keyframe = False
 
     @staticmethod
-    def _packetize_fu_a(data: bytes) -> List[bytes]:
+    def _packetize_fu_a(data: memoryview, view: memoryview, offset: int, packets: List[memoryview]) -> int:
         available_size = PACKET_MAX - FU_A_HEADER_SIZE
         payload_size = len(data) - NAL_HEADER_SIZE
         num_packets = math.ceil(payload_size / available_size)
@@ -56,114 +165,116 @@ class H264Encoder:
 
         fu_indicator = f_nri | NAL_TYPE_FU_A
 
-        fu_header_end = bytes([fu_indicator, nal | 0x40])
-        fu_header_middle = bytes([fu_indicator, nal])
-        fu_header_start = bytes([fu_indicator, nal | 0x80])
-        fu_header = fu_header_start
+        fu_header = nal | 0x80 # start
 
-        packages = []
-        offset = NAL_HEADER_SIZE
-        while offset < len(data):
+        i = NAL_HEADER_SIZE
+        while i < len(data):
             if num_larger_packets > 0:
                 num_larger_packets -= 1
-                payload = data[offset : offset + package_size + 1]
-                offset += package_size + 1
+                size = package_size + 1
             else:
-                payload = data[offset : offset + package_size]
-                offset += package_size
+                size = package_size
 
-            if offset == len(data):
-                fu_header = fu_header_end
+            if i + size == len(data):
+                fu_header = nal | 0x40 # end
 
-            packages.append(fu_header + payload)
+            start = offset
+            view[offset] = fu_indicator
+            view[offset + 1] = fu_header
+            offset += FU_A_HEADER_SIZE
+            view[offset : offset + size] = data[i : i + size]
+            offset += size
+            i += size
+            packets.append(view[start : offset])
 
-            fu_header = fu_header_middle
-        assert offset == len(data), "incorrect fragment data"
+            fu_header = nal # middle
+        assert i == len(data), "incorrect fragment data"
 
-        return packages
+        return offset
 
     @staticmethod
     def _packetize_stap_a(
-        data: bytes, packages_iterator: Iterator[bytes]
-    ) -> Tuple[bytes, bytes]:
+        nalus: List[memoryview], index: int, view: memoryview, offset: int, packets: List[memoryview]
+    ) -> Tuple[int, int]:
         counter = 0
         available_size = PACKET_MAX - STAP_A_HEADER_SIZE
 
+        data = nalus[index]
         stap_header = NAL_TYPE_STAP_A | (data[0] & 0xE0)
 
-        payload = bytes()
-        try:
-            nalu = data  # with header
-            while len(nalu) <= available_size and counter < 9:
-                stap_header |= nalu[0] & 0x80
-
-                nri = nalu[0] & 0x60
-                if stap_header & 0x60 < nri:
-                    stap_header = stap_header & 0x9F | nri
+        start = offset
+        offset += NAL_HEADER_SIZE
+        while index < len(nalus) and len(nalus[index]) <= available_size and counter < 9:
+            nalu = nalus[index] # with header
+            stap_header |= nalu[0] & 0x80
 
-                available_size -= LENGTH_FIELD_SIZE + len(nalu)
-                counter += 1
-                payload += pack("!H", len(nalu)) + nalu
-                nalu = next(packages_iterator)
+            nri = nalu[0] & 0x60
+            if stap_header & 0x60 < nri:
+                stap_header = stap_header & 0x9F | nri
 
-            if counter == 0:
-                nalu = next(packages_iterator)
-        except StopIteration:
-            nalu = None
+            available_size -= LENGTH_FIELD_SIZE + len(nalu)
+            counter += 1
+            pack_into("!H", view, offset, len(nalu))
+            offset += LENGTH_FIELD_SIZE
+            view[offset : offset + len(nalu)] = nalu
+            offset += len(nalu)
+            index += 1
 
         if counter <= 1:
-            return data, nalu
+            # A lone NAL unit is sent as-is, straight out of the bitstream.
+            packets.append(data)
+            return start, index if counter else index + 1
         else:
-            return bytes([stap_header]) + payload, nalu
+            view[start] = stap_header
+            packets.append(view[start : offset])
+            return offset, index
 
     @staticmethod
-    def _split_bitstream(buf: bytes) -> Iterator[bytes]:
-        # TODO: write in a more pytonic way,
-        # translate from: https://github.com/aizvorski/h264bitstream/blob/master/h264_nal.c#L134
-        i = 0
-        while True:
-            while (buf[i] != 0 or buf[i + 1] != 0 or buf[i + 2] != 0x01) and (
-                buf[i] != 0 or buf[i + 1] != 0 or buf[i + 2] != 0 or buf[i + 3] != 0x01
-            ):
-                i += 1  # skip leading zero
-                if i + 4 >= len(buf):
-                    return
-            if buf[i] != 0 or buf[i + 1] != 0 or buf[i + 2] != 0x01:
-                i += 1
-            i += 3
-            nal_start = i
-            while (buf[i] != 0 or buf[i + 1] != 0 or buf[i + 2] != 0) and (
-                buf[i] != 0 or buf[i + 1] != 0 or buf[i + 2] != 0x01
-            ):
-                i += 1
-                # FIXME: the next line fails when reading a nal that ends
-                # exactly at the end of the data
-                if i + 3 >= len(buf):
-                    nal_end = len(buf)
-                    yield buf[nal_start:nal_end]
-                    return  # did not find nal end, stream ended first
-            nal_end = i
-            yield buf[nal_start:nal_end]
-
-    @classmethod
-    def _packetize(cls, packages: Iterator[bytes]) -> List[bytes]:
+    def _split_bitstream(buf: bytes) -> Iterator[memoryview]:
+        # NAL units are delimited by 3-byte start codes (00 00 01).  A 4-byte 
+        # start code is a 3-byte start code with a leading zero, which we trim 
+        # from the end of the previous NAL unit along with any other trailing 
+        # zeros.  bytes.find does the scanning in C, and the NAL units are 
+        # returned as memoryview slices of buf, so nothing gets copied.
+        if not isinstance(buf, (bytes, bytearray)):
+            buf = bytes(buf)
+        view = memoryview(buf)
+        i = buf.find(START_CODE)
+        while i>=0:
+            nal_start = i + len(START_CODE)
+            i = buf.find(START_CODE, nal_start)
+            nal_end = len(buf) if i<0 else i
+            while nal_end>nal_start and buf[nal_end-1]==0:
+                nal_end -= 1
+            if nal_end>nal_start:
+                yield view[nal_start:nal_end]
+
+    def _packetize(self, nalus: List[memoryview]) -> List[memoryview]:
         packetized_packages = []
 
-        packages_iterator = iter(packages)
-        package = next(packages_iterator, None)
-        while package is not None:
-            if len(package) > PACKET_MAX:
-                packetized_packages.extend(cls._packetize_fu_a(package))
-                package = next(packages_iterator, None)
+        t = self.profiler.start()
+        # Upper bound on the size of the packetized frame: each NAL unit gets at 
+        # most a STAP-A length field, and a FU-A header per fragment.
+        size = NAL_HEADER_SIZE
+        for nalu in nalus:
+            size += len(nalu) + LENGTH_FIELD_SIZE + FU_A_HEADER_SIZE*(len(nalu)//(PACKET_MAX - FU_A_HEADER_SIZE) + 1)
+        view = memoryview(self.pool.get(size))
+
+        offset = 0
+        index = 0
+        while index < len(nalus):
+            if len(nalus[index]) > PACKET_MAX:
+                offset = self._packetize_fu_a(nalus[index], view, offset, packetized_packages)
+                index += 1
             else:
-                packetized, package = cls._packetize_stap_a(package, packages_iterator)
-                packetized_packages.append(packetized)
+                offset, index = self._packetize_stap_a(nalus, index, view, offset, packetized_packages)
 
+        self.profiler.mark("packetize", t)
         return packetized_packages
 
     def _encode_frame(
-        self, frame, force_keyframe: bool
-    ) -> Iterator[bytes]:
+        self, frame, force_keyframe: bool, format: str
+    ) -> List[memoryview]:
         if force_keyframe:
             logger.debug("force keyframe")
             # If a keyframe is forced, it's usually because the browser is confused. 
@@ -174,19 +285,29 @@ class H264Encoder:
             self.codec = kritter.Encoder(bitrate=self.target_bitrate, resolution=self.resolution)
         if self.codec.bitrate!=self.__target_bitrate:
             self.codec.bitrate = self.__target_bitrate
-        if self.codec.resolution!=(frame.shape[1], frame.shape[0]):
-            self.codec.resolution = (frame.shape[1], frame.shape[0])
+        resolution = frame_resolution(frame, format)
+        if self.codec.resolution!=resolution:
+            self.codec.resolution = resolution
             
-        data_to_send = self.codec.encode(cv2.cvtColor(frame, cv2.COLOR_BGR2YUV_I420))
+        t = self.profiler.start()
+        frame = convert_to_i420(frame, format)
+        t = self.profiler.mark("convert", t)
+        data_to_send = self.codec.encode(frame)
+        t = self.profiler.mark("encode", t)
 
         if data_to_send:
-            yield from self._split_bitstream(data_to_send)
+            nalus = list(self._split_bitstream(data_to_send))
+            self.profiler.mark("split", t)
+            self.keyframe = any(nalu[0]&0x1F==NAL_TYPE_IDR for nalu in nalus)
+            return nalus
+        self.keyframe = False
+        return []
 
     def encode(
-        self, frame, force_keyframe: bool = False
-    ) -> List[bytes]:
-        packages = self._encode_frame(frame, force_keyframe)
-        return self._packetize(packages)
+        self, frame, force_keyframe: bool = False, format: str = "BGR24"
+    ) -> List[memoryview]:
+        nalus = self._encode_frame(frame, force_keyframe, format)
+        return self._packetize(nalus)
 
     @property
     def target_bitrate(self) -> int:
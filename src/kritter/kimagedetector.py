@@ -8,7 +8,7 @@
 # support@charmedlabs.com. 
 #
 
-from kritter import get_color
+from kritter import get_color, CalcDaytime
 import cv2 
         
 class KimageDetector:
@@ -19,41 +19,426 @@ class KimageDetector:
     def detect(self, image, threshold=None):
         pass
 
+    # Detectors that can run several images in one inference should override 
+    # this.  
+    def detect_batch(self, images, threshold=None):
+        return [self.detect(image, threshold) for image in images]
+
     def classes(self):
         return self._classes
 
-from threading import Thread, Lock
+import time
+import numpy as np
+from threading import Thread, Lock, Event
+from kritter.framepool import FrameRef
+from scipy.optimize import linear_sum_assignment
+
+# Maximum distance (pixels) a detection can move between detector results and 
+# still be considered the same object by DetectionInterpolator 
+INTERPOLATE_DISTANCE = 100
+# MotionGatedDetector defaults -- (day, night) pixel difference thresholds 
+# (night frames are noisier), fraction of pixels that must change, downscale 
+# factor, crop margin (pixels), and maximum time (seconds) between detections
+MOTION_THRESHOLD = (20, 40)
+MOTION_FRACTION = 0.001
+MOTION_SCALE = 8
+MOTION_MARGIN = 32
+MOTION_REFRESH = 10
+
+
+# Detection results stored as parallel columns rather than a list of dicts.  
+# boxes is an (n, 4) int array, scores a float array, classes a list of 
+# class names, and indexes (optional) an int array of class indexes.  
+# Tracked results (DetectionTracker) also have ids, and may have per-object 
+# class0/score0 for objects matched in the current frame.  
+#
+# Detectors and DetectionTracker return Detections only when asked to 
+# (columns=True) -- by default they return the usual list of dicts and 
+# {id: dict} dictionary.  For convenience, untracked detections can be read 
+# like a list of dicts (iterating yields {"box", "class", "score", "index"} 
+# dicts), and tracked detections like an {id: dict} dictionary (iterating 
+# yields ids, and keys(), values(), items() and dets[id] work).  These dicts 
+# are copies -- modify the columns instead, or use tolist()/todict() to get 
+# plain (JSON-serializable) lists and dictionaries.  
+class Detections:
+    def __init__(self, boxes=None, scores=None, classes=None, indexes=None, ids=None, matched=None, class0=None, score0=None):
+        self.boxes = np.zeros((0, 4), dtype=int) if boxes is None else np.asarray(boxes, dtype=int).reshape(-1, 4)
+        n = len(self.boxes)
+        self.scores = np.zeros(n) if scores is None else np.asarray(scores, dtype=float)
+        self.classes = [None]*n if classes is None else list(classes)
+        self.indexes = None if indexes is None else np.asarray(indexes, dtype=int)
+        self.ids = None if ids is None else np.asarray(ids, dtype=int)
+        self.matched = None if matched is None else np.asarray(matched, dtype=bool)
+        self.class0 = class0
+        self.score0 = score0
+        self._rows = None
+
+    @classmethod
+    def from_list(cls, dets):
+        # Create from a list of detection dicts.
+        if isinstance(dets, Detections):
+            return dets
+        if isinstance(dets, dict):
+            return cls.from_dict(dets)
+        indexes = [det['index'] for det in dets] if dets and all('index' in det for det in dets) else None
+        res = cls([det['box'][0:4] for det in dets], [det['score'] for det in dets], [det['class'] for det in dets], indexes)
+        if any('score0' in det for det in dets):
+            res.matched = np.array(['score0' in det for det in dets], dtype=bool)
+            res.class0 = [det.get('class0') for det in dets]
+            res.score0 = np.array([det.get('score0', 0) for det in dets], dtype=float)
+        return res
+
+    @classmethod
+    def from_dict(cls, dets):
+        # Create from an {id: dict} dictionary (tracked detections).
+        res = cls.from_list(list(dets.values()))
+        res.ids = np.array(list(dets.keys()), dtype=int)
+        return res
+
+    @classmethod
+    def concatenate(cls, detections):
+        detections = [cls.from_list(d) for d in detections]
+        if len(detections)==0:
+            return cls()
+        indexes = None if any(d.indexes is None for d in detections) else np.concatenate([d.indexes for d in detections])
+        return cls(np.concatenate([d.boxes for d in detections]), np.concatenate([d.scores for d in detections]), [c for d in detections for c in d.classes], indexes)
+
+    def select(self, rows):
+        # Returns the detections in rows (index array, boolean mask or slice).
+        if isinstance(rows, slice):
+            rows = np.arange(len(self))[rows]
+        rows = np.asarray(rows)
+        if rows.dtype==bool:
+            rows = np.nonzero(rows)[0]
+        take = lambda column: None if column is None else column[rows]
+        res = Detections(self.boxes[rows], self.scores[rows], [self.classes[i] for i in rows], take(self.indexes), take(self.ids), take(self.matched))
+        if self.matched is not None:
+            res.class0 = [self.class0[i] for i in rows]
+            res.score0 = self.score0[rows]
+        return res
+
+    def det(self, i):
+        # Returns row i as a dict. 
+        det = {"box": self.boxes[i].tolist(), "class": self.classes[i], "score": float(self.scores[i])}
+        if self.indexes is not None:
+            det['index'] = int(self.indexes[i])
+        if self.matched is not None and self.matched[i]:
+            det['class0'] = self.class0[i]
+            det['score0'] = float(self.score0[i])
+        return det
+
+    def tolist(self):
+        return [self.det(i) for i in range(len(self))]
+
+    def todict(self):
+        return dict(self.items())
+
+    def _row(self, key):
+        if self._rows is None:
+            self._rows = {int(id_): i for i, id_ in enumerate(self.ids)}
+        return self._rows[key]
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def __add__(self, other):
+        return Detections.concatenate((self, other))
+
+    def __iter__(self):
+        if self.ids is None:
+            return iter(self.tolist())
+        return iter(self.ids.tolist())
+
+    def __getitem__(self, key):
+        if isinstance(key, (slice, np.ndarray, list)):
+            return self.select(key)
+        return self.det(key if self.ids is None else self._row(key))
+
+    def __contains__(self, key):
+        if self.ids is None:
+            return key in self.tolist()
+        return key in self.ids
+
+    def keys(self):
+        return range(len(self)) if self.ids is None else self.ids.tolist()
+
+    def values(self):
+        return self.tolist()
+
+    def items(self):
+        return zip(self.keys(), self.values())
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except (KeyError, IndexError):
+            return default
+
+    def __repr__(self):
+        return f"Detections({self.todict() if self.ids is not None else self.tolist()})"
+
+
+# Detector results are (detections, image) tuples.  DetectorResult is still 
+# a 2-tuple, but it also carries the timestamp and index of the source frame, 
+# and whether the detections were interpolated rather than detected.  If the
+# image is a view of a FramePool buffer, ref is the FrameRef that keeps it 
+# valid.  
+class DetectorResult(tuple):
+    def __new__(cls, dets, image, timestamp=None, index=None, interpolated=False, ref=None):
+        res = super().__new__(cls, (dets, image))
+        res.timestamp = timestamp
+        res.index = index
+        res.interpolated = interpolated
+        res.ref = ref
+        return res
+
+
+# Cheap motion model for propagating detections between detector results. 
+# Detections are matched with the previous result to estimate velocities, 
+# which are then used to extrapolate the boxes to a given timestamp. 
+class DetectionInterpolator:
+    def __init__(self, maxDistance=INTERPOLATE_DISTANCE):
+        self.maxDistance = maxDistance
+        self.dets = []
+        self.boxes = np.zeros((0, 4))
+        self.velocity = np.zeros((0, 4))
+        self.timestamp = None
+
+    def _centroids(self, dets, boxes):
+        # Add class index (if any) so that objects of different classes don't match. 
+        if isinstance(dets, Detections):
+            index = np.zeros(len(dets)) if dets.indexes is None else dets.indexes*10000
+        else:
+            index = np.array([det.get('index', 0) for det in dets])*10000
+        return np.vstack(((boxes[:, 0] + boxes[:, 2])/2, (boxes[:, 1] + boxes[:, 3])/2, index)).T
+
+    def update(self, dets, timestamp):
+        if dets is None:
+            dets = []
+        if isinstance(dets, Detections):
+            boxes = dets.boxes.astype(float)
+        else:
+            boxes = np.array([det['box'][0:4] for det in dets], dtype=float).reshape(-1, 4)
+        velocity = np.zeros((len(dets), 4))
+        if len(self.dets) and len(dets) and self.timestamp is not None and timestamp>self.timestamp:
+            D = np.linalg.norm(self._centroids(self.dets, self.boxes)[:, None] - self._centroids(dets, boxes)[None, :], axis=2)
+            rows, cols = linear_sum_assignment(np.where(D>self.maxDistance, 1e9, D))
+            valid = D[rows, cols]<=self.maxDistance
+            rows, cols = rows[valid], cols[valid]
+            velocity[cols] = (boxes[cols] - self.boxes[rows])/(timestamp - self.timestamp)
+        self.dets = dets
+        self.boxes = boxes
+        self.velocity = velocity
+        self.timestamp = timestamp
+
+    def predict(self, timestamp):
+        # Returns the detections in the same form (Detections or list) that 
+        # was passed to update(). 
+        if self.timestamp is None:
+            return []
+        boxes = (self.boxes + self.velocity*(timestamp - self.timestamp)).astype(int)
+        boxes[boxes<0] = 0
+        if isinstance(self.dets, Detections):
+            dets = self.dets.select(slice(None))
+            dets.boxes = boxes
+            return dets
+        return [{**det, "box": box.tolist()} for det, box in zip(self.dets, boxes)]
+
 
 class KimageDetectorThread(KimageDetector):
-    def __init__(self, detector):
+    # rate limits the number of detections per second, and budget limits the 
+    # fraction of a CPU core the detector thread uses.  If interpolate is True,
+    # detect() returns detections propagated to the current frame (see 
+    # DetectionInterpolator) when no new detector result is available.
+    def __init__(self, detector, rate=None, budget=None, interpolate=False):
         self.detector = detector 
+        self.rate = rate
+        self.budget = budget
+        self.interpolator = DetectionInterpolator() if interpolate else None
         self.lock = Lock()
+        self.new_image = Event()
+        self.stop = Event()
         self.thread = None
         self.result = None
+        self.frame = None
+        # FrameRefs held for the pending frame and the last returned result
+        self.frame_ref = self.returned_ref = None
 
     def detect(self, image, threshold=None):
-        self.image = image
+        ref = source = None
+        # If we get a FrameRef (FramePool), hold a reference to the frame 
+        # instead of copying it.  The frame is released when it's replaced.
+        # Results for pooled frames have a read-only view of the frame, which
+        # stays valid until the next result is returned.  Callers that keep 
+        # the frame longer should call result.ref.retain(), and callers that 
+        # draw on it should copy it.  
+        if isinstance(image, FrameRef):
+            source = image
+            ref = image.retain()
+            image, timestamp, index = ref.frame, ref.timestamp, ref.index
+        # If we get a tuple, assume that it's a (frame, timestamp, index) tuple.
+        elif isinstance(image, tuple):
+            image, timestamp, index = image[0:3]
+        else:
+            timestamp, index = time.time(), None
+        with self.lock:
+            self.frame = image, timestamp, index
+            # Release the pending frame if the thread didn't get to it.
+            ref, self.frame_ref = self.frame_ref, ref
+        if ref:
+            ref.release()
         self.threshold = threshold
+        self.new_image.set()
         if not self.thread:
             self.run_thread = True
+            self.stop.clear()
             self.thread = Thread(target=self.run)
             self.thread.start()
         with self.lock:
             result = self.result 
             self.result = None
+        if self.interpolator:
+            if result is not None:
+                self.interpolator.update(result[0], result.timestamp)
+            elif self.interpolator.timestamp is not None:
+                result = DetectorResult(self.interpolator.predict(timestamp), image, timestamp, index, True, source.retain() if source else None)
+        if result is not None:
+            # Release the previously returned result's frame.
+            ref, self.returned_ref = self.returned_ref, result.ref
+            if ref:
+                ref.release()
         return result 
 
     def run(self):
         while self.run_thread:
-            active_image = self.image
+            # Wait for an image we haven't seen yet.
+            if not self.new_image.wait(0.1):
+                continue
+            self.new_image.clear()
+            with self.lock:
+                active_image, timestamp, index = self.frame
+                active_ref, self.frame_ref = self.frame_ref, None
+            t0 = time.time()
             result = self.detector.detect(active_image, self.threshold)
+            t = time.time() - t0
             with self.lock:
-                self.result = result, active_image
+                # Release the previous result's frame if it wasn't returned.
+                ref = self.result.ref if self.result is not None else None
+                self.result = DetectorResult(result, active_image, timestamp, index, ref=active_ref)
+            if ref:
+                ref.release()
+            # Throttle the detector to meet the rate and CPU budget.
+            sleep = 0
+            if self.rate:
+                sleep = max(sleep, 1/self.rate - t)
+            if self.budget:
+                sleep = max(sleep, t*(1/self.budget - 1))
+            if sleep>0:
+                self.stop.wait(sleep)
 
     def close(self):
         if self.thread:
             self.run_thread = False
+            self.stop.set()
             self.thread.join()
+            self.thread = None
+        for ref in (self.frame_ref, self.returned_ref, self.result.ref if self.result is not None else None):
+            if ref:
+                ref.release()
+        self.frame_ref = self.returned_ref = self.result = None
+
+class MotionGatedDetector(KimageDetector):
+    # Runs the detector only when the frame has changed since the last frame 
+    # that was run, otherwise the previous result is returned.  Detection is 
+    # cropped to the bounding box of the changed regions (plus margin), and 
+    # previous detections outside the crop are kept.  Motion is found by 
+    # differencing frames downscaled by scale.  threshold is the (day, night) 
+    # pixel difference and fraction is the fraction of (downscaled) pixels that
+    # must change.  Daytime is determined by daytime (CalcDaytime).  The 
+    # detector is also run at least every refresh seconds.  
+    def __init__(self, detector, threshold=MOTION_THRESHOLD, fraction=MOTION_FRACTION, scale=MOTION_SCALE, margin=MOTION_MARGIN, refresh=MOTION_REFRESH, daytime=None):
+        super().__init__()
+        self.detector = detector
+        self.threshold = threshold
+        self.fraction = fraction
+        self.scale = scale
+        self.margin = margin
+        self.refresh = refresh
+        self.daytime = daytime if daytime else CalcDaytime()
+        self.reset()
+
+    def reset(self):
+        self.reference = self.small = None
+        self.result = Detections()
+        # The result in the form the detector returns (list or Detections)
+        self.output = []
+        self.t0 = 0
+        self.frames = self.skipped = self.cropped = 0
+
+    def classes(self):
+        return self.detector.classes()
+
+    def _detect(self, image, threshold):
+        dets = self.detector.detect(image, threshold)
+        # KimageDetectorThread returns (dets, image) DetectorResults. 
+        if isinstance(dets, DetectorResult):
+            dets = dets[0]
+        # Detectors may return None if there's nothing to report.
+        return [] if dets is None else dets
+
+    def motion(self, image):
+        # Returns the bounding box of the motion (in image coordinates) or None.
+        small = cv2.cvtColor(image[::self.scale, ::self.scale], cv2.COLOR_BGR2GRAY)
+        small = cv2.blur(small, (3, 3))
+        self.small = small
+        if self.reference is None or self.reference.shape!=small.shape:
+            self.reference = small
+            return 0, 0, image.shape[1], image.shape[0]
+        daytime, _ = self.daytime.is_daytime(image)
+        threshold = self.threshold[0] if daytime else self.threshold[1]
+        moving = cv2.absdiff(small, self.reference)>threshold
+        if np.count_nonzero(moving)<=self.fraction*moving.size:
+            return None
+        # The reference is only updated when we detect, so slow motion 
+        # accumulates instead of being missed. 
+        self.reference = small
+        ys, xs = np.nonzero(moving)
+        box = np.array([xs.min(), ys.min(), xs.max() + 1, ys.max() + 1])*self.scale + (-self.margin, -self.margin, self.margin, self.margin)
+        return max(box[0], 0), max(box[1], 0), min(box[2], image.shape[1]), min(box[3], image.shape[0])
+
+    def detect(self, image, threshold=None):
+        self.frames += 1
+        t = time.time()
+        box = self.motion(image)
+        if box is None:
+            if t-self.t0<self.refresh:
+                self.skipped += 1
+                return self.output
+            box = 0, 0, image.shape[1], image.shape[0]
+            # Motion is measured against this frame from now on.
+            self.reference = self.small
+        self.t0 = t
+        x0, y0, x1, y1 = [int(i) for i in box]
+        if x1-x0==image.shape[1] and y1-y0==image.shape[0]:
+            dets = self._detect(image, threshold)
+            self.result = Detections.from_list(dets)
+        else:
+            self.cropped += 1
+            dets = self._detect(image[y0:y1, x0:x1], threshold)
+            crop = Detections.from_list(dets)
+            crop.boxes += (x0, y0, x0, y0)
+            # Keep previous detections that lie outside the cropped region.
+            boxes = self.result.boxes
+            outside = (boxes[:, 2]<=x0) | (boxes[:, 0]>=x1) | (boxes[:, 3]<=y0) | (boxes[:, 1]>=y1)
+            self.result = Detections.concatenate((crop, self.result.select(outside)))
+        # Return the same type as the detector.
+        self.output = self.result if isinstance(dets, Detections) else self.result.tolist()
+        return self.output
+
+    def stats(self):
+        # ratio is the fraction of frames that skipped inference. 
+        return {"frames": self.frames, "skipped": self.skipped, "cropped": self.cropped, "ratio": self.skipped/self.frames if self.frames else 0}
+
 
 def _hash(string):
     val = 7
@@ -93,27 +478,29 @@ def _get_det_color(det):
         color = get_color(index)
     return color
 
+def _detected_items(detected):
+    # Returns (key, det) pairs.  Detectors return lists (or untracked 
+    # Detections), which have no keys.  DetectionTracker returns tracked 
+    # Detections (or a dictionary) with the keys being the object IDs.
+    if isinstance(detected, Detections):
+        return detected.items() if detected.ids is not None else ((None, det) for det in detected)
+    if isinstance(detected, dict):
+        return detected.items()
+    if isinstance(detected, list):
+        return ((None, det) for det in detected)
+    return ()
+
 def render_detected(overlay, detected, label_format=None, font="sans-serif", font_size=12, line_width=2, scale=1):
     overlay.draw_clear(id='render_detected_box')
     if label_format is None:
         label_format = lambda key, det : f"{det['class']} {det['score']*100:.0f}%" 
 
-    if isinstance(detected, list):
-        for i in detected:
-            try:
-                txt = label_format(None, i)
-                render_detected_box(overlay, _get_det_color(i), txt, i['box'], font, font_size, line_width, scale)
-            except KeyError:
-                pass
-
-    # DetectionTracker uses a dictionary with the keys being the indexes
-    if isinstance(detected, dict):
-        for i, v in detected.items():
-            try:
-                txt = label_format(i, v)
-                render_detected_box(overlay, _get_det_color(v), txt, v['box'], font, font_size, line_width, scale)
-            except KeyError:
-                pass
+    for i, v in _detected_items(detected):
+        try:
+            txt = label_format(i, v)
+            render_detected_box(overlay, _get_det_color(v), txt, v['box'], font, font_size, line_width, scale)
+        except KeyError:
+            pass
 
     return overlay.out_draw()
 
@@ -170,22 +557,11 @@ def render_detected_image(image, detected, label_format=None, x_offset=0, y_offs
 
     if label_format is None:
         label_format = lambda key, det : f"{det['class']} {det['score']*100:.0f}%" 
-    _detected = detected.values() if isinstance(detected, dict) else detected
-    if isinstance(detected, list):
-        for i in detected:
-            try:
-                txt = label_format(None, i)
-                render_detected_box_image(image, _get_det_color(i), txt, i['box'], x_offset, y_offset, font, font_size, font_width, line_width, padding, center, label_on_top, bg, bg_outline, bg_color, bg_3d)
-            except KeyError:
-                pass
-
-    # DetectionTracker uses a dictionary with the keys being the indexes
-    if isinstance(detected, dict):
-        for i, v in detected.items():
-            try:
-                txt = label_format(i, v)
-                render_detected_box_image(image, _get_det_color(v), txt, v['box'], x_offset, y_offset, font, font_size, font_width, line_width, padding, center, label_on_top, bg, bg_outline, bg_color, bg_3d)
-            except KeyError:
-                pass
+    for i, v in _detected_items(detected):
+        try:
+            txt = label_format(i, v)
+            render_detected_box_image(image, _get_det_color(v), txt, v['box'], x_offset, y_offset, font, font_size, font_width, line_width, padding, center, label_on_top, bg, bg_outline, bg_color, bg_3d)
+        except KeyError:
+            pass
 
 
@@ -0,0 +1,172 @@
+#
+# This file is part of Kritter 
+#
+# All Kritter source code is provided under the terms of the
+# GNU General Public License v2 (http://www.gnu.org/licenses/gpl-2.0.html).
+# Those wishing to use Kritter source code, software and/or
+# technologies under different licensing terms should contact us at
+# support@charmedlabs.com. 
+#
+
+import time
+from queue import Queue, Empty
+from threading import Thread, Lock
+from concurrent.futures import Future
+from .kimagedetector import KimageDetector
+from .profiler import Profiler
+
+QUEUE_SIZE = 4 # pending requests per model
+MAX_BATCH = 4 
+
+
+# A model in a KimageDetectorPool.  It has the same detect()/classes() 
+# interface as KimageDetector, but detection is carried out by the model's 
+# workers.  detect_async() returns a Future instead of waiting.
+class PooledDetector(KimageDetector):
+    def __init__(self, name, detectors, batch, queue_size):
+        super().__init__()
+        self.name = name
+        self.detectors = detectors
+        self.batch = batch
+        self.queue = Queue(maxsize=queue_size)
+        self.profiler = Profiler(enabled=True)
+        # batches and images are updated by all of the workers.
+        self.lock = Lock()
+        self.batches = self.images = 0
+        self.run_thread = True
+        self.threads = [Thread(target=self.run, args=(d,)) for d in detectors]
+        for t in self.threads:
+            t.start()
+
+    def detect_async(self, image, threshold=None):
+        if not self.run_thread:
+            raise RuntimeError(f"Model {self.name} is closed.")
+        future = Future()
+        # Blocks if the queue is full, which keeps callers from getting ahead
+        # of the workers.
+        self.queue.put((image, threshold, future, time.perf_counter()))
+        # We may have been closed while waiting.
+        if not self.run_thread:
+            self._drain()
+        return future
+
+    def detect(self, image, threshold=None):
+        return self.detect_async(image, threshold).result()
+
+    def classes(self):
+        return self.detectors[0].classes()
+
+    def stats(self):
+        with self.lock:
+            batch = self.images/self.batches if self.batches else 0
+        return {"queue": self.queue.qsize(), "workers": len(self.detectors), "batch": batch, **self.profiler.stats()["stages"]}
+
+    def run(self, detector):
+        pending = None
+        while self.run_thread:
+            if pending is None:
+                try:
+                    pending = self.queue.get(timeout=0.1)
+                except Empty:
+                    continue
+            # Coalesce whatever else is waiting (with the same threshold) into 
+            # a batch.
+            batch = [pending]
+            pending = None
+            while len(batch)<self.batch:
+                try:
+                    request = self.queue.get_nowait()
+                except Empty:
+                    break
+                if request[1]!=batch[0][1]:
+                    pending = request
+                    break
+                batch.append(request)
+            t = self.profiler.start()
+            try:
+                results = detector.detect_batch([r[0] for r in batch], batch[0][1])
+            except Exception as e:
+                for r in batch:
+                    r[2].set_exception(e)
+                continue
+            t = self.profiler.mark("inference", t)
+            with self.lock:
+                self.batches += 1
+                self.images += len(batch)
+            for r, result in zip(batch, results):
+                r[2].set_result(result)
+                self.profiler.record("latency", t - r[3])
+        if pending:
+            self._closed(pending)
+
+    def _closed(self, request):
+        if request[2].set_running_or_notify_cancel():
+            request[2].set_exception(RuntimeError(f"Model {self.name} is closed."))
+
+    def _drain(self):
+        # Fail requests that will never be carried out so that callers 
+        # waiting on them don't hang.
+        while True:
+            try:
+                self._closed(self.queue.get_nowait())
+            except Empty:
+                break
+
+    def close(self):
+        self.run_thread = False
+        for t in self.threads:
+            t.join()
+        self._drain()
+
+
+# Runs one or more detector models, each with its own worker threads and 
+# bounded request queue, so that models don't contend without coordination.
+# Each worker owns its own detector (interpreter) instance, created by calling 
+# the model's factory function.  Workers pass the pending requests (up to 
+# batch) to the detector's detect_batch() together.  Only detectors that 
+# override detect_batch() run them as one inference -- TFliteDetector doesn't
+# (the TFLite Task Library detects one image per call), so its batches are 
+# run an image at a time.  For example: 
+#
+#   pool = KimageDetectorPool()
+#   objects = pool.add_model("objects", TFliteDetector, workers=2)
+#   custom = pool.add_model("custom", lambda: TFliteDetector("custom.tflite"))
+#   dets = objects.detect(image)
+#
+class KimageDetectorPool:
+    def __init__(self):
+        self.models = {}
+        self.lock = Lock()
+
+    def add_model(self, name, factory, workers=1, batch=MAX_BATCH, queue_size=QUEUE_SIZE):
+        # Check before creating the detectors so that a duplicate doesn't 
+        # create (and leak) them. 
+        with self.lock:
+            if name in self.models:
+                raise RuntimeError(f"Model {name} already exists.")
+        detectors = [factory() for i in range(workers)]
+        with self.lock:
+            if name in self.models:
+                raise RuntimeError(f"Model {name} already exists.")
+            self.models[name] = PooledDetector(name, detectors, batch, queue_size)
+        return self.models[name]
+
+    def remove_model(self, name):
+        with self.lock:
+            model = self.models.pop(name)
+        model.close()
+
+    def __getitem__(self, name):
+        return self.models[name]
+
+    def stats(self):
+        with self.lock:
+            models = dict(self.models)
+        return {name: model.stats() for name, model in models.items()}
+
+    def close(self):
+        with self.lock:
+            models = list(self.models.values())
+            self.models = {}
+        for model in models:
+            model.close()
@@ -12,7 +12,9 @@ import os
 import time
 import cv2
 from threading import Timer
+from concurrent.futures import Future
 from .util import temp_file
+from .framepool import FrameRef
 PROGRESS_TIMEOUT = 2 # seconds
 
 class KstoreMedia:
@@ -21,6 +23,10 @@ class KstoreMedia:
         pass
 
     def store_image_array(self, array, album="", desc="", data={}):
+        # The image is written before we return, so a FrameRef's frame can be
+        # used without copying.
+        if isinstance(array, FrameRef):
+            array = array.frame
         temp = temp_file("jpg")
         cv2.imwrite(temp, array)
         return self.store_image_file(temp, album, desc, data)
@@ -28,6 +34,17 @@ class KstoreMedia:
     def store_image_file(self, filename, album="", desc="", data={}, thumbnail=None):
         pass
 
+    # Returns a Future that's set to the result of store_image_file().  Stores
+    # that can commit several files at once (e.g. GPstoreMedia) override this
+    # and set the Future when the file's batch is committed.  
+    def store_image_file_async(self, filename, album="", desc="", data={}):
+        future = Future()
+        try:
+            future.set_result(self.store_image_file(filename, album, desc, data))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
     def store_video_stream(self, stream, fps=30, album="", desc="", data={}, thumbnail=False, progress_callback=None):
         frame = stream.frame()
         if thumbnail:
@@ -64,5 +81,19 @@ class KstoreMedia:
     def store_video_file(self, filename, album="", desc="", data={}, thumbnail=None):
         pass
 
+    # Stores a (large) file in chunks so that a failed transfer can be resumed.
+    # state is a dict describing the transfer so far (empty for a new 
+    # transfer).  save_state(state) is called after each chunk so that the 
+    # caller can persist the state and pass it back to resume after a dropped 
+    # connection or restart.  Stores that don't support resuming just store 
+    # the whole file.  
+    def store_video_file_resumable(self, filename, album="", desc="", data={}, state=None, save_state=None):
+        return self.store_video_file(filename, album, desc, data)
+
     def get_share_url(self, album):
         pass
+
+    # Commits anything that's pending (e.g. batched media items) and releases
+    # resources.  
+    def close(self):
+        pass
@@ -24,6 +24,8 @@ import dash_html_components as html
 import plotly.graph_objs as go
 from functools import wraps
 from .koverlay import Koverlay 
+from .h264 import frame_resolution, convert_to_i420
+from .framepool import FrameRef
 
 # Maximum encoding area.  Not all browsers can accept full HD video.  
 # This keeps the encoding resolution reasonably low, but can be increased with 
@@ -68,11 +70,13 @@ class Kvideo(Kcomponent):
 
         self.hist_update_period = kwargs['hist_update_period'] if 'hist_update_period' in kwargs else 0.25
         self.hist_update_time = 0
+        simulcast = kwargs['simulcast'] if 'simulcast' in kwargs else False
+        profile = kwargs['profile'] if 'profile' in kwargs else False
 
         self.hist = html.Div(dcc.Graph(id=self.hist_graph_id, style=self._hist_style(), config={'displayModeBar': False}), id=self.hist_id, style={"display": "block" if self.hist_disp else "none"})
         if src is None:           
             self.video = KvideoComp(id=self.id, style=self._video_style())
-            self.streamer = Streamer(server=self.kapp.server, html=None, js=None)
+            self.streamer = Streamer(server=self.kapp.server, html=None, js=None, simulcast=simulcast, profile=profile)
         else:
             self.video = html.Video(id=self.id, src=self._build_src(src), controls=controls, muted=True, autoPlay=autoplay, loop=loop, style=self._video_style())
             self.streamer = None
@@ -239,16 +243,31 @@ class Kvideo(Kcomponent):
             # and toss the timestamp and index.
             if isinstance(frame, tuple):
                 frame = frame[0]
-            self._update_source_resolution(frame.shape[1], frame.shape[0])
-            if frame.shape[0]!=self.enc_height or frame.shape[1]!=self.enc_width:
-                frame = cv2.resize(frame, (self.enc_width, self.enc_height))
-            self.streamer.push_frame(frame, frameperiod)
+            # A FrameRef (FramePool) is passed to the streamer as-is, which 
+            # holds a reference to it, unless it's resized here. 
+            source = frame
+            if isinstance(frame, FrameRef):
+                frame = frame.frame
+            self._update_source_resolution(*frame_resolution(frame, format))
+            if frame_resolution(frame, format)!=(self.enc_width, self.enc_height):
+                # Resize and convert to I420 in one step, so the encoder 
+                # doesn't need to convert again.
+                t = self.streamer.profiler.start()
+                frame = convert_to_i420(frame, format, (self.enc_width, self.enc_height))
+                self.streamer.profiler.mark("frame resize", t)
+                format = "I420"
+                source = frame
+            self.streamer.push_frame(source, frameperiod, format)
             if self.hist_disp:
                 t = time.time()
                 # The update rate is intended to be lower than the framerate.
                 # It takes about 10ms to create the complete histogram on a
                 # Raspberry Pi 4.  So 4Hz or 250ms is about 4% of a CPU core.
                 if t - self.hist_update_time > self.hist_update_period:
+                    if format=="I420":
+                        frame = cv2.cvtColor(frame, cv2.COLOR_YUV2BGR_I420)
+                    elif format=="NV12":
+                        frame = cv2.cvtColor(frame, cv2.COLOR_YUV2BGR_NV12)
                     self._update_histogram(frame)
                     self.hist_update_time = t
 
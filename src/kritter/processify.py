@@ -8,42 +8,370 @@
 # support@charmedlabs.com. 
 #
 
-import time
-# SharedMemoryManager would be better than BaseManager for Python v3.8 or greater
-from multiprocessing.managers import BaseManager 
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+import numpy as np
+import multiprocessing
+from multiprocessing.managers import BaseManager
+# Shared memory requires Python 3.8 or greater.  Without it, arrays are
+# pickled like everything else.
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    shared_memory = None
 
 SOCKET = 56579
+# Arrays smaller than this (bytes) are pickled, larger arrays are passed
+# through shared memory.
+SHM_MIN_SIZE = 64*1024
+# Number of other-process segments to keep attached
+SHM_CACHE_SIZE = 16
+# Number of concurrent call_async() calls
+ASYNC_WORKERS = 4
 
-class _Manager(BaseManager): 
+class _Manager(BaseManager):
     pass
 
-def _server(Cls, args, socket):
-    obj = Cls(*args)
+
+# Describes an array in a shared memory segment.
+class _SharedArray:
+    def __init__(self, name, offset, shape, dtype):
+        self.name = name
+        self.offset = offset
+        self.shape = shape
+        self.dtype = dtype
+
+
+# Reusable shared memory segment that arrays are packed into.  It's replaced
+# by a larger segment if it's too small.
+class _Arena:
+    def __init__(self):
+        self.shm = None
+
+    def reserve(self, size):
+        if self.shm is None or self.shm.size<size:
+            self.close()
+            self.shm = shared_memory.SharedMemory(create=True, size=max(size, SHM_MIN_SIZE))
+
+    def close(self):
+        if self.shm:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+
+# Encodes and decodes call arguments and return values.  Each side owns
+# arenas that it writes arrays into, and attaches to the other side's
+# segments to read them.
+class _Transport:
+    def __init__(self):
+        self.attached = OrderedDict()
+        # Evicted segments that still have arrays (views) referring to them
+        self.retired = []
+        self.lock = threading.Lock()
+
+    def _arrays(self, value, arrays):
+        if isinstance(value, np.ndarray):
+            if value.nbytes>=SHM_MIN_SIZE:
+                arrays.append(value)
+        # Only containers that _encode() rebuilds -- arrays in tuple subclasses
+        # (named tuples, etc.) are pickled along with them.
+        elif type(value) in (list, tuple):
+            for v in value:
+                self._arrays(v, arrays)
+        elif type(value) is dict:
+            for v in value.values():
+                self._arrays(v, arrays)
+        return arrays
+
+    def _encode(self, value, arena, offsets):
+        if isinstance(value, np.ndarray):
+            try:
+                offset = offsets[id(value)]
+            except KeyError:
+                return value
+            return _SharedArray(arena.shm.name, offset, value.shape, value.dtype.str)
+        # Don't rebuild tuple subclasses (named tuples, etc.)
+        if type(value) in (list, tuple):
+            return type(value)(self._encode(v, arena, offsets) for v in value)
+        if type(value) is dict:
+            return {k: self._encode(v, arena, offsets) for k, v in value.items()}
+        return value
+
+    def encode(self, value, arena):
+        # Copy large arrays in value into arena, replacing them with
+        # _SharedArray descriptors.
+        if shared_memory is None:
+            return value
+        arrays = self._arrays(value, [])
+        if not arrays:
+            return value
+        # Align each array to 64 bytes.
+        sizes = [(a.nbytes + 63)//64*64 for a in arrays]
+        arena.reserve(sum(sizes))
+        offsets = {}
+        offset = 0
+        for a, size in zip(arrays, sizes):
+            dst = np.ndarray(a.shape, dtype=a.dtype, buffer=arena.shm.buf, offset=offset)
+            np.copyto(dst, a)
+            offsets[id(a)] = offset
+            offset += size
+        return self._encode(value, arena, offsets)
+
+    def _attach(self, name):
+        with self.lock:
+            try:
+                shm = self.attached[name]
+                self.attached.move_to_end(name)
+                return shm
+            except KeyError:
+                pass
+            # The owner unlinks the segment, so don't let the resource tracker
+            # unlink it (again) when we exit.  
+            try:
+                shm = shared_memory.SharedMemory(name=name, track=False)
+            except TypeError: # Python 3.12 and earlier
+                shm = shared_memory.SharedMemory(name=name)
+                # Forked processes share the owner's resource tracker, which
+                # already tracks the segment.  
+                if multiprocessing.get_start_method()!="fork":
+                    try:
+                        resource_tracker.unregister(shm._name, "shared_memory")
+                    except Exception:
+                        pass
+            self.attached[name] = shm
+            # Segments that have been replaced are no longer used.
+            while len(self.attached)>SHM_CACHE_SIZE:
+                self.retired.append(self.attached.popitem(last=False)[1])
+            self._close_retired()
+            return shm
+
+    def _close_retired(self):
+        # A segment can't be closed (unmapped) while there are arrays that 
+        # refer to it -- close() raises BufferError, and we try again later.
+        for shm in list(self.retired):
+            try:
+                shm.close()
+                self.retired.remove(shm)
+            except BufferError:
+                pass
+
+    def decode(self, value, copy=True):
+        # Replace _SharedArray descriptors in value with arrays.  If copy is
+        # False, the arrays are read-only views of the shared memory, which 
+        # are only valid until the other side reuses its arena.
+        if isinstance(value, _SharedArray):
+            shm = self._attach(value.name)
+            dtype = np.dtype(value.dtype)
+            size = int(np.prod(value.shape))*dtype.itemsize
+            # Each array gets its own memoryview of the segment, which keeps 
+            # the segment mapped for as long as the array (or any view of it) 
+            # exists, see _close_retired().
+            array = np.frombuffer(shm.buf[value.offset:value.offset + size], dtype=dtype).reshape(value.shape)
+            if copy:
+                return array.copy()
+            array.flags.writeable = False
+            return array
+        if type(value) in (list, tuple):
+            return type(value)(self.decode(v, copy) for v in value)
+        if type(value) is dict:
+            return {k: self.decode(v, copy) for k, v in value.items()}
+        return value
+
+    def close(self):
+        with self.lock:
+            self.retired += self.attached.values()
+            self.attached.clear()
+            self._close_retired()
+
+
+# Served object -- dispatches calls to the proxied object, decoding arguments
+# and encoding return values.  Each manager connection is served by its own
+# thread, so each thread gets its own arena for return values.  Array 
+# arguments are copied out of shared memory unless views is True. 
+class _Dispatcher:
+    def __init__(self, obj, views=False):
+        self.obj = obj
+        self.views = views
+        self.transport = _Transport()
+        self.local = threading.local()
+        self.arenas = []
+
+    def _arena(self):
+        try:
+            return self.local.arena
+        except AttributeError:
+            arena = self.local.arena = _Arena()
+            self.arenas.append(arena)
+            return arena
+
+    def call(self, name, args, kwargs):
+        # With views, arguments are read-only views of the caller's shared 
+        # memory -- they are only valid for the duration of the call.
+        args = self.transport.decode(args, not self.views)
+        kwargs = self.transport.decode(kwargs, not self.views)
+        res = getattr(self.obj, name)(*args, **kwargs)
+        return self.transport.encode(res, self._arena())
+
+    def call_batch(self, calls):
+        # Carry out a list of (name, args, kwargs) calls in order.  Returns a 
+        # list of (exception, result) pairs so that one failing call doesn't
+        # lose the other results.  
+        calls = self.transport.decode(calls, not self.views)
+        res = []
+        for name, args, kwargs in calls:
+            try:
+                res.append((None, getattr(self.obj, name)(*args, **kwargs)))
+            except Exception as e:
+                res.append((e, None))
+        return self.transport.encode(res, self._arena())
+
+    def close(self):
+        self.transport.close()
+        for arena in self.arenas:
+            arena.close()
+
+
+def _server(Cls, args, socket, views):
+    dispatcher = _Dispatcher(Cls(*args), views)
     def func():
-        return obj
+        return dispatcher
     _Manager.register('server', callable=func)
 
+# Collects calls made within a Processify.batch() context and sends them in 
+# one message when the context exits.  Each call returns a Future, which is 
+# resolved when the context exits.  
+class _Batch:
+    def __init__(self, proc):
+        self.proc = proc
+        self.calls = []
+        self.futures = []
+
+    def call(self, name, *args, **kwargs):
+        future = Future()
+        self.calls.append((name, args, kwargs))
+        self.futures.append(future)
+        return future
+
+    def __getattr__(self, attr):
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+        return lambda *args, **kwargs: self.call(attr, *args, **kwargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None and self.calls:
+            try:
+                res = self.proc._call_batch(self.calls)
+            except Exception as e:
+                res = [(e, None)]*len(self.futures)
+            for future, (e, r) in zip(self.futures, res):
+                if e is None:
+                    future.set_result(r)
+                else:
+                    future.set_exception(e)
+        else:
+            for future in self.futures:
+                future.cancel()
+
+
 # This class proxies a class instance in a separate process.  
 # It's remarkable how little code takes!  
+# Large NumPy arrays in arguments and return values are passed through shared
+# memory, so only small descriptors are pickled.  The object gets its own 
+# copies of array arguments.  If views is True, it gets read-only views of the 
+# shared memory instead, which saves a copy but are only valid until the 
+# method returns -- so only use views if the object's methods don't keep 
+# their array arguments.  call_async() returns a
+# Future, so several calls can be in flight (pipelined) at once, and batch()
+# sends several calls in one message:
+#
+#   with proc.batch() as batch:
+#       dets = batch.detect(image)
+#       classes = batch.classes()
+#   print(dets.result(), classes.result())
+#
 class Processify:
 
-    def __init__(self, Cls, args=(), socket=SOCKET):
+    def __init__(self, Cls, args=(), socket=SOCKET, views=False):
         # Setup and connect to server
         _Manager.register('server')
         self.manager = _Manager(address=('localhost', socket), authkey=Cls.__name__.encode())
-        self.manager.start(initializer=lambda: _server(Cls, args, socket))
-        # Connecting to server might need to wait a bit...
-        while True:
-            try:
-                self.manager.connect()
-                break
-            except ConnectionRefusedError:
-                time.sleep(0.1)
+        # The server process constructs the object (initializer) and then 
+        # starts listening before it sends its address back, which start() 
+        # waits for.  So when start() returns, the server is ready and we're 
+        # connected -- no need to poll.
+        if shared_memory:
+            # Start the resource tracker before the server is forked so that
+            # both processes share it, see _Transport._attach().
+            resource_tracker.ensure_running()
+        try:
+            self.manager.start(initializer=lambda: _server(Cls, args, socket, views))
+        except EOFError:
+            raise RuntimeError(f"Processify: unable to start server for {Cls.__name__}")
         self.server = self.manager.server()
+        self.transport = _Transport()
+        # Arenas for arguments, one per call in flight
+        self.arenas = []
+        self.arenas_lock = threading.Lock()
+        self.executor = None
+
+    def _get_arena(self):
+        with self.arenas_lock:
+            if self.arenas:
+                return self.arenas.pop()
+        return _Arena()
+
+    def _put_arena(self, arena):
+        with self.arenas_lock:
+            self.arenas.append(arena)
+
+    def call(self, name, *args, **kwargs):
+        arena = self._get_arena() if shared_memory else None
+        try:
+            args = self.transport.encode(args, arena)
+            kwargs = self.transport.encode(kwargs, arena)
+            res = self.server.call(name, args, kwargs)
+            # Copy return values out of shared memory because the server
+            # reuses its arena on the next call.
+            return self.transport.decode(res)
+        finally:
+            if arena:
+                self._put_arena(arena)
+
+    def _call_batch(self, calls):
+        arena = self._get_arena() if shared_memory else None
+        try:
+            res = self.server.call_batch(self.transport.encode(calls, arena))
+            return self.transport.decode(res)
+        finally:
+            if arena:
+                self._put_arena(arena)
+
+    def batch(self):
+        return _Batch(self)
+
+    def call_async(self, name, *args, **kwargs):
+        # Each worker thread has its own connection to the server, so calls
+        # are carried out concurrently.
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(ASYNC_WORKERS)
+        return self.executor.submit(self.call, name, *args, **kwargs)
 
     def __getattr__(self, attr):
-        return getattr(self.server, attr)    
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+        return lambda *args, **kwargs: self.call(attr, *args, **kwargs)
 
     def close(self):
+        if self.executor:
+            self.executor.shutdown()
+        self.server.close()
+        self.transport.close()
+        for arena in self.arenas:
+            arena.close()
         self.manager.shutdown()
         self.manager.join()
@@ -0,0 +1,88 @@
+#
+# This file is part of Kritter 
+#
+# All Kritter source code is provided under the terms of the
+# GNU General Public License v2 (http://www.gnu.org/licenses/gpl-2.0.html).
+# Those wishing to use Kritter source code, software and/or
+# technologies under different licensing terms should contact us at
+# support@charmedlabs.com. 
+#
+
+import time
+import numpy as np
+from threading import Lock
+
+PROFILE_SIZE = 1000 # number of samples kept for each stage
+PROFILE_PERCENTILES = (50, 90, 99)
+# Histogram bin edges in milliseconds
+PROFILE_BINS = (0, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class ProfileStage:
+    def __init__(self, size):
+        # Fixed-size ring buffer of the most recent samples (seconds)
+        self.samples = np.zeros(size)
+        self.n = 0
+
+    def record(self, dt):
+        self.samples[self.n%len(self.samples)] = dt
+        self.n += 1
+
+    def stats(self):
+        samples = self.samples[0:min(self.n, len(self.samples))]*1000 # ms
+        if len(samples)==0:
+            return {"count": 0}
+        percentiles = np.percentile(samples, PROFILE_PERCENTILES)
+        stats = {"count": self.n, "mean": float(np.mean(samples)), "max": float(np.max(samples))}
+        for p, v in zip(PROFILE_PERCENTILES, percentiles):
+            stats[f"p{p}"] = float(v)
+        stats["hist"] = np.histogram(samples, bins=PROFILE_BINS)[0].tolist()
+        return stats
+
+
+# Opt-in profiler that records per-stage timing.  When disabled, start() returns
+# None and mark() does nothing, so instrumented code pays almost nothing.
+# Typical usage:
+#
+#   t = profiler.start()
+#   do_something()
+#   t = profiler.mark("something", t)
+#   do_something_else()
+#   profiler.mark("something else", t)
+#
+class Profiler:
+    def __init__(self, size=PROFILE_SIZE, enabled=False):
+        self.size = size
+        self.enabled = enabled
+        self.stages = {}
+        self.lock = Lock()
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def reset(self):
+        with self.lock:
+            self.stages = {}
+
+    def start(self):
+        return time.perf_counter() if self.enabled else None
+
+    def mark(self, stage, t0):
+        if t0 is None:
+            return None
+        t = time.perf_counter()
+        self.record(stage, t-t0)
+        return t
+
+    def record(self, stage, dt):
+        try:
+            self.stages[stage].record(dt)
+        except KeyError:
+            with self.lock:
+                self.stages[stage] = ProfileStage(self.size)
+            self.stages[stage].record(dt)
+
+    def stats(self):
+        with self.lock:
+            stages = dict(self.stages)
+        return {"enabled": self.enabled, "bins": PROFILE_BINS, "stages": {k: v.stats() for k, v in stages.items()}}
@@ -14,6 +14,53 @@ from quart import Response, Blueprint, request, websocket
 import aiohttp
 
 ERROR_400 = "", 400
+# Connection pool limits and keep-alive timeout (seconds) for upstream 
+# connections
+CONNECTION_LIMIT = 32
+KEEPALIVE_TIMEOUT = 30
+CONNECT_TIMEOUT = 10
+# An upstream read that stalls for this long (seconds) ends the request, which
+# frees its pooled connection
+READ_TIMEOUT = 60
+# Response bodies are streamed in chunks of this size (bytes)
+CHUNK_SIZE = 64*1024
+# Hop-by-hop headers apply to a single connection, so they aren't forwarded.  
+# Host and Content-Length are set by aiohttp/Quart.
+HOP_HEADERS = {"connection", "keep-alive", "proxy-authenticate", "proxy-authorization", "te", "trailer", "trailers", "transfer-encoding", "upgrade", "host", "content-length"}
+
+def _forward_headers(headers, exclude=HOP_HEADERS):
+    # Returns (key, value) pairs rather than a dictionary so that repeated 
+    # headers (Set-Cookie, etc.) are all forwarded.  
+    return [(k, v) for k, v in headers.items() if k.lower() not in exclude]
+
+# Streams an upstream response body so that large files (videos, etc.) are 
+# proxied with constant memory.  The upstream response (and its pooled 
+# connection) is released when the body ends or fails, when Quart closes the 
+# body, or when the body is garbage-collected without having been sent (e.g. 
+# the client disconnected first).  
+class _Body:
+    def __init__(self, resp):
+        self.resp = resp
+        self.chunks = resp.content.iter_chunked(CHUNK_SIZE)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.chunks.__anext__()
+        except (aiohttp.client_exceptions.ClientPayloadError, asyncio.TimeoutError):
+            self.resp.release()
+            raise StopAsyncIteration
+        except BaseException:
+            self.resp.release()
+            raise
+
+    async def aclose(self):
+        self.resp.release()
+
+    def __del__(self):
+        self.resp.release()
 
 # This web proxy receives on quart and sends on aiohttp
 class Proxy:
@@ -21,6 +68,7 @@ class Proxy:
     def __init__(self, host="http://localhost:5000", websockets=['_push']):
         self.host = host
         self.websockets = websockets
+        self.session = None
         self.server = Blueprint(f'Proxy{self.host.replace(".", "_")}', __name__)
 
         # Set up HTTP GET, POST handlers
@@ -28,31 +76,50 @@ class Proxy:
         @self.server.route('/<path:path>', methods=['GET', 'POST'])
         async def proxy(path):
             path = os.path.join(self.host, path)
-            if request.method=='GET':
-                async with aiohttp.ClientSession(cookies=request.cookies) as session:
-                    try:
-                        async with session.get(path) as resp:
-                            return Response(await resp.read(), mimetype=resp.content_type)
-                    except (aiohttp.client_exceptions.ClientConnectorError, aiohttp.client_exceptions.ClientOSError):
-                        return ERROR_400
-            else: # POST
-                data = await request.get_data()
-                async with aiohttp.ClientSession(cookies=request.cookies) as session:
-                    try:
-                        async with session.post(path, data=data, headers=dict(request.headers)) as resp:
-                            return Response(await resp.read(), mimetype=resp.content_type)
-                    except (aiohttp.client_exceptions.ClientConnectorError, aiohttp.client_exceptions.ClientOSError):
-                        return ERROR_400
+            # Headers (cookies, Range, If-None-Match, etc.) are passed through 
+            # to the host, and the host's headers (Content-Range, ETag, etc.) 
+            # are passed back.  
+            headers = _forward_headers(request.headers)
+            data = await request.get_data() if request.method=='POST' else None
+            try:
+                resp = await self._session().request(request.method, path, data=data, headers=headers)
+            except (aiohttp.client_exceptions.ClientConnectorError, aiohttp.client_exceptions.ClientOSError, asyncio.TimeoutError):
+                return ERROR_400
+
+            response = Response(_Body(resp), status=resp.status, headers=_forward_headers(resp.headers, HOP_HEADERS-{"content-length"}))
+            # Don't time out long downloads.
+            response.timeout = None
+            return response
+
+        @self.server.after_app_serving
+        async def close():
+            await self.close()
 
         # Set up websocket handlers
         for w in self.websockets:
             self.server.websocket(w)(self.ws_func(w))
 
+    def _session(self):
+        # One long-lived session (connection pool) per host, created on first 
+        # use so that it belongs to the server's event loop.  Cookies are 
+        # passed through as headers, so the session doesn't keep any.  The 
+        # body is passed through as-is (compressed or not). 
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=CONNECTION_LIMIT, keepalive_timeout=KEEPALIVE_TIMEOUT)
+            timeout = aiohttp.ClientTimeout(total=None, sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=timeout, cookie_jar=aiohttp.DummyCookieJar(), auto_decompress=False)
+        return self.session
+
+    async def close(self):
+        if self.session:
+            await self.session.close()
+            self.session = None
+
     def ws_func(self, path):
         async def func():
-            session = aiohttp.ClientSession(cookies=websocket.cookies)
+            headers = {"Cookie": websocket.headers["Cookie"]} if "Cookie" in websocket.headers else None
             try: 
-                async with session.ws_connect(os.path.join(self.host, path)) as ws:
+                async with self._session().ws_connect(os.path.join(self.host, path), headers=headers) as ws:
 
                     async def recv():
                         while True:
@@ -10,81 +10,343 @@
 
 import os 
 import json
-from time import sleep
-from threading import Thread
+import ctypes
+import ctypes.util
+import select
+import struct
+import logging
+from bisect import insort
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from threading import Thread, Lock
 from .kstoremedia import KstoreMedia
-from .util import file_extension, file_basename, valid_image_name, valid_video_name, valid_media_name, date_stamped_file, load_metadata, save_metadata
+from .util import file_extension, file_basename, valid_image_name, valid_video_name, valid_media_name, date_stamped_file, load_metadata, save_metadata, get_metadata_filename
 
 UPLOADED_KEY = "_uploaded"
+UPLOAD_STATE_KEY = "_upload_state"
 KEEP = 100
+# Directory is rescanned this often (seconds) if inotify isn't available
+POLL_PERIOD = 1
+# Number of concurrent uploads
+UPLOAD_WORKERS = 2
+# Failed uploads are retried with exponential backoff -- after RETRY_PERIOD, 
+# then twice that, etc., up to RETRY_MAX (seconds)
+RETRY_PERIOD = 1
+RETRY_MAX = 300
+# Upload throughput is measured over this window (seconds)
+THROUGHPUT_WINDOW = 60
 
+# inotify event flags, see inotify(7)
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CLOSE_WRITE = 0x08
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_EVENT = struct.Struct("iIII")
+
+logger = logging.getLogger(__name__)
+from .util import set_logger_level
+#set_logger_level(logger, logging.DEBUG)
+
+
+# Reports files that are added to or removed from a directory.  It uses 
+# inotify if it's available, and falls back to polling the directory 
+# otherwise.  changes() returns (added, removed) sets of filenames.  If the 
+# inotify queue overflows (events are lost), the directory is rescanned.  
+class DirWatcher:
+    def __init__(self, path, files=()):
+        self.path = path
+        self.files = set(files)
+        self.fd = -1
+        # wake() interrupts wait() 
+        self.wake_r, self.wake_w = os.pipe()
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            self.fd = libc.inotify_init()
+            if self.fd>=0 and libc.inotify_add_watch(self.fd, path.encode(), IN_MOVED_TO | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_DELETE)<0:
+                os.close(self.fd)
+                self.fd = -1
+        except (AttributeError, OSError, TypeError):
+            self.fd = -1
+
+    def wait(self, timeout):
+        # Wait for changes or wake().  In polling mode there might be changes
+        # at any time, so we just wait.
+        fds = [self.wake_r] if self.fd<0 else [self.fd, self.wake_r]
+        if self.wake_r in select.select(fds, [], [], timeout)[0]:
+            os.read(self.wake_r, 4096)
+
+    def wake(self):
+        os.write(self.wake_w, b"\0")
+
+    def _rescan(self):
+        files = set(os.listdir(self.path))
+        added, removed = files-self.files, self.files-files
+        self.files = files
+        return added, removed
+
+    def changes(self):
+        if self.fd<0:
+            return self._rescan()
+        added, removed = set(), set()
+        overflow = False
+        while select.select([self.fd], [], [], 0)[0]:
+            buf = os.read(self.fd, 64*1024)
+            i = 0
+            while i<len(buf):
+                wd, mask, cookie, length = IN_EVENT.unpack_from(buf, i)
+                i += IN_EVENT.size
+                name = buf[i:i+length].rstrip(b"\0").decode()
+                i += length
+                if mask&IN_Q_OVERFLOW:
+                    overflow = True
+                elif mask&(IN_MOVED_TO | IN_CLOSE_WRITE):
+                    added.add(name)
+                    removed.discard(name)
+                else:
+                    removed.add(name)
+                    added.discard(name)
+        if overflow:
+            return self._rescan()
+        self.files |= added
+        self.files -= removed
+        return added, removed
+
+    @property
+    def polling(self):
+        return self.fd<0
+
+    def close(self):
+        if self.fd>=0:
+            os.close(self.fd)
+            self.fd = -1
+        if self.wake_r>=0:
+            os.close(self.wake_r)
+            os.close(self.wake_w)
+            self.wake_r = self.wake_w = -1
+
+
+# Saves media files to path and uploads them to store_media (if specified) 
+# with up to workers concurrent uploads.  priority determines the upload 
+# order -- "oldest" first, "newest" first, or a key function that's passed the
+# filename and its metadata.  Failed uploads are retried with exponential 
+# backoff.  stats() returns the backlog and throughput.  
 class SaveMediaQueue(KstoreMedia):
 
-    def __init__(self, store_media=None, path="", keep=KEEP, keep_uploaded=KEEP):
+    def __init__(self, store_media=None, path="", keep=KEEP, keep_uploaded=KEEP, workers=UPLOAD_WORKERS, priority="oldest"):
         super().__init__()
         self.store_media = store_media
         self.path = path
         self.keep = keep
         self.keep_uploaded = keep_uploaded
+        self.priority = priority
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(workers)
+        # Files being uploaded, files whose bytes are uploaded and are waiting
+        # to be committed (in a batch), and (attempts, retry time) of failed 
+        # files
+        self.uploading = set()
+        self.committing = set()
+        self.retries = {}
+        self.completed = deque()
+        self.uploads = self.failures = 0
         if not os.path.isdir(self.path):
             os.system(f"mkdir -p {self.path}")
+        # In-memory index of media files -- sorted lists of files that haven't
+        # been uploaded (preuploaded) and files that have, and each file's 
+        # [uploaded, priority key].  It's built once here and then kept up to 
+        # date from directory changes.  
+        self.lock = Lock()
+        self.index = {}
+        self.preuploaded = []
+        self.uploaded = []
+        files = sorted(os.listdir(self.path))
+        self.watcher = DirWatcher(self.path, files)
+        for file in files:
+            self._add(file)
         self.thread_ = Thread(target=self.thread)
         self.run_thread = True
         self.thread_.start()
 
     def close(self):
         self.run_thread = False
+        self.watcher.wake()
         self.thread_.join()
+        # Wait for uploads in progress.  store_media belongs to the caller, 
+        # who closes it (committing anything it has batched).  
+        self.executor.shutdown()
+        self.watcher.close()
+
+    def _add(self, file):
+        if not valid_media_name(file):
+            return
+        with self.lock:
+            if file in self.index:
+                return
+            metadata = load_metadata(os.path.join(self.path, file))
+            uploaded = bool(metadata.get(UPLOADED_KEY))
+            # Compute the priority key once, here, where we already have the 
+            # metadata.  
+            key = self.priority(file, metadata) if callable(self.priority) and not uploaded else None
+            self.index[file] = [uploaded, key]
+            insort(self.uploaded if uploaded else self.preuploaded, file)
+
+    def _discard(self, file):
+        with self.lock:
+            try:
+                uploaded = self.index.pop(file)[0]
+            except KeyError:
+                return
+            (self.uploaded if uploaded else self.preuploaded).remove(file)
+            self.retries.pop(file, None)
+
+    def _update(self):
+        added, removed = self.watcher.changes()
+        for file in removed:
+            self._discard(file)
+        for file in sorted(added):
+            self._add(file)
+
+    def _upload(self, file):
+        # Returns a Future that's set to True if the file was uploaded.  Image 
+        # uploads are committed in batches (if store_media supports it), so 
+        # the Future may be set after this returns. 
+        fullfile = os.path.join(self.path, file)                        
+        metadata = load_metadata(fullfile)
+        logger.debug(f"uploading {file}")
+        # Resumable upload state is saved in the metadata, but it isn't part
+        # of the description.
+        state = metadata.pop(UPLOAD_STATE_KEY, {})
+        def save_state(state):
+            save_metadata(fullfile, {**metadata, UPLOAD_STATE_KEY: state})
+        result = Future()
+        def done(res):
+            if res:
+                logger.debug(f"uploaded {file}")
+                # preuploaded file becomes uploaded filed
+                metadata[UPLOADED_KEY] = True
+                save_metadata(fullfile, metadata)
+            else:
+                logger.warning(f"error uploading {file} to {metadata.get('album')}")
+            result.set_result(bool(res))
+        def failed(e):
+            logger.warning(f"exception uploading {file}: {e}")
+            result.set_result(False)
+        def committed(future):
+            try:
+                res = future.result()
+            except Exception as e:
+                failed(e)
+                return
+            done(res)
+        try:
+            album = metadata['album'] if 'album' in metadata else ""
+            desc =  json.dumps(metadata) if metadata else ""
+            if valid_video_name(file):
+                # Videos are uploaded in chunks and resumed after failures.
+                res = self.store_media.store_video_file_resumable(fullfile, album, desc, state=state, save_state=save_state)
+            else:
+                self.store_media.store_image_file_async(fullfile, album, desc).add_done_callback(committed)
+                return result
+        except Exception as e:
+            failed(e)
+            return result
+        done(res)
+        return result
+
+    def _retain(self):
+        # Remove the oldest files beyond keep and keep_uploaded, but not files
+        # that are being uploaded.  
+        for files, keep in ((self.preuploaded, self.keep), (self.uploaded, self.keep_uploaded)):
+            with self.lock:
+                excess = [f for f in files[0:max(len(files)-keep, 0)] if f not in self.uploading and f not in self.committing]
+                for file in excess:
+                    files.remove(file)
+                    del self.index[file]
+                    self.retries.pop(file, None)
+            for file in excess:
+                file = os.path.join(self.path, file)
+                for f in (file, get_metadata_filename(file)):
+                    try:
+                        os.remove(f)
+                    except:
+                        pass
+
+    def _upload_task(self, file):
+        future = self._upload(file)
+        # The worker is free once the bytes are uploaded -- the file is 
+        # finished when its batch is committed. 
+        with self.lock:
+            self.uploading.discard(file)
+            self.committing.add(file)
+        # Start the next upload. 
+        self.watcher.wake()
+        future.add_done_callback(lambda future: self._finish(file, future.result()))
+
+    def _finish(self, file, success):
+        t = time.time()
+        with self.lock:
+            self.committing.discard(file)
+            if success:
+                self.uploads += 1
+                self.completed.append(t)
+                self._trim(t)
+                self.retries.pop(file, None)
+                # Make sure the file wasn't removed in the meantime. 
+                entry = self.index.get(file)
+                if entry and not entry[0]:
+                    self.index[file] = [True, None]
+                    self.preuploaded.remove(file)
+                    insort(self.uploaded, file)
+            else:
+                self.failures += 1
+                attempts = self.retries[file][0]+1 if file in self.retries else 1
+                self.retries[file] = attempts, t + min(RETRY_PERIOD*2**(attempts-1), RETRY_MAX)
+        self.watcher.wake()
+
+    def _schedule(self):
+        # Start uploads for files that are ready, in priority order, until 
+        # the workers are busy.  Returns how long until a retry is due (or 
+        # None).
+        t = time.time()
+        with self.lock:
+            free = self.workers - len(self.uploading)
+            busy = self.uploading | self.committing
+            ready = [f for f in self.preuploaded if f not in busy and (f not in self.retries or self.retries[f][1]<=t)]
+            retry = min((r[1] for f, r in self.retries.items() if f not in busy), default=None)
+            if callable(self.priority):
+                ready.sort(key=lambda f: self.index[f][1])
+        if free<=0 or not ready:
+            return None if retry is None else max(retry-t, 0)
+        if self.priority=="newest":
+            ready.reverse()
+        with self.lock:
+            for file in ready[0:free]:
+                self.uploading.add(file)
+                self.executor.submit(self._upload_task, file)
+        return None if retry is None else max(retry-t, 0)
+
+    def _trim(self, t):
+        # Keep only the completion times within the throughput window.  
+        while self.completed and t-self.completed[0]>THROUGHPUT_WINDOW:
+            self.completed.popleft()
+
+    def stats(self):
+        t = time.time()
+        with self.lock:
+            self._trim(t)
+            return {"backlog": len(self.preuploaded), "uploading": len(self.uploading), "committing": len(self.committing), "retrying": len(self.retries), "uploaded": self.uploads, "failed": self.failures, "throughput": len(self.completed)/THROUGHPUT_WINDOW}
 
     def thread(self):
         while self.run_thread:
-            uploaded = []
-            preuploaded = []
-            # find all images in path
-            files = os.listdir(self.path)
-            files = sorted(files)
-            for file in files:
-                if not self.run_thread:
-                    break
-                if not valid_media_name(file):
-                    continue
-                fullfile = os.path.join(self.path, file)                        
-                metadata = load_metadata(fullfile)
-                try:
-                    if metadata[UPLOADED_KEY]:
-                        uploaded.append(file)
-                        continue
-                except:
-                    preuploaded.append(file)
-                if self.store_media is not None:
-                    print('Uploading', file)
-                    try:
-                        album = metadata['album'] if 'album' in metadata else ""
-                        desc =  json.dumps(metadata) if metadata else ""
-                        if self.store_media.store_image_file(fullfile, album, desc):
-                            print('done')
-                            # preuploaded file becomes uploaded filed
-                            metadata[UPLOADED_KEY] = True
-                            save_metadata(fullfile, metadata)
-                            preuploaded.remove(file)
-                            uploaded.append(file)
-                        else:
-                            print(f"Error uploading {file} to {metadata['album']}")
-                    except Exception as e:
-                        print('Exception uploading', file, e)
-            # clean up preuploaded and uploaded files
-            for files, keep in ((preuploaded, self.keep), (uploaded, self.keep_uploaded)):
-                if len(files)>keep:
-                    files = sorted(files)
-                    for i in range(len(files)-keep):
-                        file = os.path.join(self.path, files[i])
-                        for f in (file, file_basename(file)+".json"):
-                            try:
-                                os.remove(f)
-                            except:
-                                pass
-            # don't thrash
-            sleep(1)
+            self._update()
+            retry = None
+            if self.store_media is not None:
+                retry = self._schedule()
+            self._retain()
+            # Wait for directory changes, finished uploads or retries. 
+            self.watcher.wait(POLL_PERIOD if retry is None else min(retry, POLL_PERIOD))
 
     def _get_filename(self, ext):
         return os.path.join(self.path, date_stamped_file(ext))
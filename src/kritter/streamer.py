@@ -15,17 +15,18 @@ import time
 import fractions
 import contextvars
 import cv2
-from queue import Queue, Full, Empty 
+from collections import deque
 from threading import Thread, Lock
 import aiortc.rtcrtpsender as rtcrtpsender
 from aiortc.codecs import CODECS
-from aiortc.mediastreams import MediaStreamTrack, VIDEO_TIME_BASE, convert_timebase
+from aiortc.mediastreams import MediaStreamTrack, MediaStreamError, VIDEO_TIME_BASE, convert_timebase
 from aiortc import RTCPeerConnection, RTCSessionDescription
 import aiortc.codecs.base
 from quart import Response, request, Quart, jsonify
-from .h264 import H264Encoder
+from .h264 import H264Encoder, FORMATS, frame_resolution, convert_to_i420
+from .profiler import Profiler
+from .framepool import FrameRef
 
-MAX_TIMEOUTS = 3
 BITRATE_WINDOW = 2 # seconds
 MIN_FRAMERATE = 1 # frames/sec
 DEFAULT_BITRATE = 3000000 # Mbps
@@ -33,11 +34,28 @@ MAX_BITRATE = DEFAULT_BITRATE*2
 # Frameperiod adjustment rate -- lower means slower
 FRAMEPERIOD_ADJ_RATE = 0.5
 PADDING_ADJ_RATE = 0.8
-QUEUE_TIMEOUT = 1 # seconds
+# If a client hasn't picked up a frame in this long, assume it's gone away.
+STALL_TIMEOUT = 6 # seconds
+# A client that dropped a frame waits for the next keyframe on its layer.  If
+# there isn't one within this long, a keyframe is forced.  
+RESYNC_TIMEOUT = 3 # seconds
+# Minimum time between keyframes forced to resync clients that dropped frames.
+RESYNC_PERIOD = 1 # seconds
 MAX_PADDING = 8000
 MIN_PADDING = 500
 PADDING_PACKET = 1300
 MAX_FRAMEPERIOD = 1/MIN_FRAMERATE # Change MIN_FRAMERATE instead
+# Simulcast layers as (resolution scale, bitrate) tuples, highest quality first.  
+# A stream is assigned to the first layer whose bitrate its REMB history can sustain.
+SIMULCAST_LAYERS = ((1, DEFAULT_BITRATE), (0.5, DEFAULT_BITRATE//3), (0.25, DEFAULT_BITRATE//10))
+REMB_HISTORY = 4 # number of REMB updates per stream used for layer selection
+# A stream can sustain a layer if its REMB is at least this fraction of the layer's 
+# bitrate.  (The layer bitrate is a ceiling -- frameperiod and padding adaptation 
+# take care of the rest.) 
+LAYER_HEADROOM = 0.5
+
+# Padding packets are all slices of this shared, read-only zero buffer.
+PADDING = memoryview(bytes(PADDING_PACKET))
 
 logger = logging.getLogger(__name__)
 from .util import set_logger_level
@@ -150,15 +168,14 @@ def fps():
 fps.t0 = fps.n = 0
 
 
-class Encoder(aiortc.codecs.base.Encoder):
-    def __init__(self, framerate=30):
-        self.streams = []
-        self.mr_frame = None
+class EncoderLayer:
+    def __init__(self, encoder, scale=1, bitrate=DEFAULT_BITRATE):
+        self.encoder = encoder
+        self.scale = scale
+        self.bitrate = bitrate
+        self.h264 = H264Encoder(bitrate=bitrate, profiler=encoder.profiler)
         self.force_keyframe = False
-        self.encoder = H264Encoder(bitrate=DEFAULT_BITRATE)
-        self.frameperiod = 1/framerate;
-        self.pts_timer = 0
-        self.current_frameperiod = self.frameperiod
+        self.current_frameperiod = encoder.frameperiod
         # Assume that we have a good connection and set padding to max.
         self.current_padding = MAX_PADDING
         self.target_bitrate_t0 = 0
@@ -167,66 +184,22 @@ class Encoder(aiortc.codecs.base.Encoder):
         self.bitrate_t0 = None
         self.bitrate_n = 0
         self.actual_bitrate = None
-        self.thread = None
-        self.slock = Lock()
-        self.flock = Lock()
-
-    def add_stream(self, stream):
-        self.slock.acquire()
-        self.streams.append(stream)
-        self.slock.release()
-        logger.debug('add_stream ' + str(len(self.streams)))
-        if len(self.streams)==1:
-            self.thread = Thread(target=self.run)
-            self.thread.start()
-
-    def remove_stream(self, stream):
-        self.slock.acquire()
-        self.streams.remove(stream)
-        self.slock.release()
-        logger.debug('remove_stream ' + str(len(self.streams)))
-
-    def timestamp(self, pts):
-        time_base = fractions.Fraction(1, 1)
-        return convert_timebase(pts, time_base, VIDEO_TIME_BASE)
-
-    def encode(self, stream, force_keyframe):
-        self.flock.acquire()
-        if (force_keyframe):
-            # If we get a forced keyframe it could be due to client's decoder
-            # giving up because of buffer overruns or bitstream errors.  
-            # We should set padding to minimum to reduce bitrate. 
-            self.current_padding = MIN_PADDING
-            self.force_keyframe = True
-        self.flock.release()
-        # Note, we might get a stop on the stream while we're waiting on the queue. 
-        # The timeout is a bit lazy, but it will never cause a deadlock.
-        for i in range(MAX_TIMEOUTS):
-            if stream in self.streams: 
-                try:
-                    return stream.queue.get(timeout=QUEUE_TIMEOUT)
-                except Empty:
-                    logger.debug("queue get timeout")
-            else:    
-                break
-        return ([], self.timestamp(stream.pts))
+        self.tn = 0
+        self.resync_t0 = 0
 
-    def send_keyframe(self):
-        self.force_keyframe = True
+    def reset(self):
+        self.actual_bitrate = self.bitrate_t0 = None
+        self.current_padding = MIN_PADDING
+        self.target_bitrate_t0 = self.bitrate_n = self.tn = 0 
 
-    def push_frame(self, frame, frameperiod=0):
-        if frame is None:
-            return
-        # If frameperiod is not zero, deliver frame at even intervals
-        if frameperiod:
-            t = time.time()
-            self.pts_timer += frameperiod 
-            sleep = self.pts_timer - t
-            if sleep>0:
-                time.sleep(sleep)
-            else: # We're late: update immediately, bring pts_timer up to date.
-                self.pts_timer = t    
-        self.mr_frame = frame
+    def resize(self, frame, format):
+        if self.scale==1:
+            return frame, format
+        # Encoder needs width and height to be evenly divisible by 16.
+        width, height = frame_resolution(frame, format)
+        width = max(16, int(width*self.scale)//16*16)
+        height = max(16, int(height*self.scale)//16*16)
+        return convert_to_i420(frame, format, (width, height)), "I420"
 
     def update_actual_bitrate(self, data):
         if self.bitrate_t0 is None:
@@ -250,10 +223,10 @@ class Encoder(aiortc.codecs.base.Encoder):
         diff = int(self.current_padding)-n
         if diff>0:
             for i in range(diff//PADDING_PACKET):
-                data.append(bytearray(PADDING_PACKET))
+                data.append(PADDING)
             mod = diff%PADDING_PACKET
             if mod:
-                data.append(bytearray(mod))
+                data.append(PADDING[:mod])
 
     @property
     def target_bitrate(self):
@@ -266,9 +239,9 @@ class Encoder(aiortc.codecs.base.Encoder):
         # Note, each client/browser will send REMB bitrate updates at 
         # a rate of about 2 Hz, so as long as the time period is greater
         # than say 0.5s, we'll get the minimum bitrate of all 
-        # clients.  Unfortunately, we can't accomodate all bitrates
-        # for all clients because we only have one encoder. But we
-        # can accomodate the client with the lowest bandwidth/bitrate
+        # clients on this layer.  Unfortunately, we can't accomodate all 
+        # bitrates for all clients because we only have one encoder per layer. 
+        # But we can accomodate the client with the lowest bandwidth/bitrate
         # abilities, which is why we're interested in the minimum.
         if val<self._min_target_bitrate:
             self._target_bitrate = val
@@ -280,8 +253,8 @@ class Encoder(aiortc.codecs.base.Encoder):
                 # Calculate frameperiod based on target_bitrate and actual_bitrate. 
                 cf = pf = self.current_frameperiod
                 cf *= 1 - FRAMEPERIOD_ADJ_RATE + FRAMEPERIOD_ADJ_RATE*self.actual_bitrate/self._min_target_bitrate
-                if cf<self.frameperiod:
-                    cf = self.frameperiod
+                if cf<self.encoder.frameperiod:
+                    cf = self.encoder.frameperiod
                 elif cf>MAX_FRAMEPERIOD:
                     cf = MAX_FRAMEPERIOD 
                 # Avoid race conditions with other threads that use current_frameperiod. 
@@ -293,69 +266,287 @@ class Encoder(aiortc.codecs.base.Encoder):
                 elif cp>MAX_PADDING:
                     cp = MAX_PADDING 
                 self.current_padding = cp
-                logger.debug(f"prev padding: {pp:.2f} padding: {self.current_padding:.2f} prev framerate: {1/pf:.2f} current framerate: {1/self.current_frameperiod:.2f} actual bitrate: {self.actual_bitrate:.2f} min target bitrate: {self._min_target_bitrate}")
+                logger.debug(f"layer {self.scale} prev padding: {pp:.2f} padding: {self.current_padding:.2f} prev framerate: {1/pf:.2f} current framerate: {1/self.current_frameperiod:.2f} actual bitrate: {self.actual_bitrate:.2f} min target bitrate: {self._min_target_bitrate}")
 
             self._min_target_bitrate = MAX_BITRATE # reset to some maximum value           
-    
-    def encode_and_send(self, frame):
+
+
+class Encoder(aiortc.codecs.base.Encoder):
+    def __init__(self, framerate=30, simulcast=False, layers=SIMULCAST_LAYERS, profile=False):
+        self.streams = []
+        self.profiler = Profiler(enabled=profile)
+        self.mr_frame = None
+        # FrameRef (FramePool) that mr_frame is a view of, if any
+        self.mr_ref = None
+        self.frameperiod = 1/framerate;
+        self.pts_timer = 0
+        self.simulcast = simulcast
+        # Without simulcast we have a single full-resolution layer that all 
+        # streams share.  With simulcast, each stream is assigned to a layer 
+        # based on its own REMB history.
+        if not simulcast:
+            layers = ((1, DEFAULT_BITRATE),)
+        self.layers = [EncoderLayer(self, scale, bitrate) for scale, bitrate in layers]
+        self.thread = None
+        self.slock = Lock()
+        self.flock = Lock()
+
+    def add_stream(self, stream):
+        self.slock.acquire()
+        stream.layer = self.layers[0]
+        self.streams.append(stream)
+        self.slock.release()
+        logger.debug('add_stream ' + str(len(self.streams)))
+        if len(self.streams)==1:
+            self.thread = Thread(target=self.run)
+            self.thread.start()
+
+    def remove_stream(self, stream):
+        self.slock.acquire()
+        # The encoder thread may have already removed a stalled stream.
+        if stream in self.streams:
+            self.streams.remove(stream)
+        self.slock.release()
+        logger.debug('remove_stream ' + str(len(self.streams)))
+
+    def timestamp(self, pts):
+        time_base = fractions.Fraction(1, 1)
+        return convert_timebase(pts, time_base, VIDEO_TIME_BASE)
+
+    def encode(self, stream, force_keyframe):
+        self.flock.acquire()
+        if (force_keyframe):
+            # If we get a forced keyframe it could be due to client's decoder
+            # giving up because of buffer overruns or bitstream errors.  
+            # We should set padding to minimum to reduce bitrate. 
+            stream.layer.current_padding = MIN_PADDING
+            stream.layer.force_keyframe = True
+        self.flock.release()
+        # StreamTrack.recv() has already waited (on the event loop) for the 
+        # frame, so there's nothing left to block on here.
+        return stream.current
+
+    def send_keyframe(self):
+        for layer in self.layers:
+            layer.force_keyframe = True
+
+    def resync(self, layer):
+        # A client that dropped a frame has waited RESYNC_TIMEOUT for a 
+        # keyframe without getting one.  Rate-limit these so that slow clients
+        # don't turn every frame into a keyframe for everyone else on the layer.
+        t = time.time()
+        if t-layer.resync_t0>RESYNC_PERIOD:
+            self.flock.acquire()
+            layer.force_keyframe = True
+            self.flock.release()
+            layer.resync_t0 = t
+
+    def stats(self):
+        self.slock.acquire()
+        stats = [{"remote_addr": s.remote_addr, "layer": s.layer.scale, "frames": s.frames, "drops": s.drops} for s in self.streams]
+        self.slock.release()
+        return stats
+
+    def push_frame(self, frame, frameperiod=0, format="BGR24", ref=None):
+        # If frame is a view of a FramePool buffer, ref is a reference that we
+        # own and release when the frame is replaced.  
+        if frame is None:
+            if ref:
+                ref.release()
+            return
+        # If frameperiod is not zero, deliver frame at even intervals
+        if frameperiod:
+            t = time.time()
+            self.pts_timer += frameperiod 
+            sleep = self.pts_timer - t
+            if sleep>0:
+                time.sleep(sleep)
+            else: # We're late: update immediately, bring pts_timer up to date.
+                self.pts_timer = t    
+        self.flock.acquire()
+        prev = self.mr_ref
+        self.mr_frame = frame, format
+        self.mr_ref = ref
+        self.flock.release()
+        if prev:
+            prev.release()
+
+    def select_layer(self, stream):
+        # Use the minimum of the stream's recent REMB values so that a stream 
+        # only moves up a layer after its link has been consistently good. 
+        bitrate = min(stream.remb)
+        for layer in self.layers:
+            if bitrate>=layer.bitrate*LAYER_HEADROOM:
+                return layer
+        return self.layers[-1]
+
+    def update_stream_bitrate(self, stream, val):
+        stream.remb.append(val)
+        if self.simulcast:
+            layer = self.select_layer(stream)
+            if layer is not stream.layer:
+                logger.debug(f"moving stream from layer {stream.layer.scale} to layer {layer.scale}")
+                self.flock.acquire()
+                # The client's decoder needs a keyframe to pick up the new 
+                # layer's resolution. 
+                layer.force_keyframe = True
+                stream.layer = layer
+                self.flock.release()
+        stream.layer.target_bitrate = val
+
+    # Without simulcast, aiortc feeds all REMB updates from all clients through 
+    # here, which throttles the (single) layer to the slowest client. 
+    @property
+    def target_bitrate(self):
+        return self.layers[0].target_bitrate
+
+    @target_bitrate.setter 
+    def target_bitrate(self, val):
+        self.layers[0].target_bitrate = val
+
+    def encode_and_send(self, layer, frame, format):
         self.flock.acquire()
-        keyframe = self.force_keyframe
+        keyframe = layer.force_keyframe
         if keyframe:    
-            self.force_keyframe = False
+            layer.force_keyframe = False
         self.flock.release()
-        data = self.encoder.encode(frame, keyframe) 
-        self.pad(data)
-        self.update_actual_bitrate(data)
+        t = self.profiler.start()
+        frame, format = layer.resize(frame, format)
+        if layer.scale!=1:
+            self.profiler.mark("layer resize", t)
+        data = layer.h264.encode(frame, keyframe, format) 
+        keyframe = layer.h264.keyframe
+        t = self.profiler.start()
+        layer.pad(data)
+        t = self.profiler.mark("pad", t)
+        layer.update_actual_bitrate(data)
+        t_handoff = t 
+        t = time.time()
         self.slock.acquire()
         for s in reversed(self.streams):
-            # We are at the mercy of the client browser to grab data in the 
-            # queue, so we need a way to detect if things have gone awry. 
-            # A series of timeouts is a good way to do this.    
+            if s.layer is not layer:
+                continue
+            # We are at the mercy of the client browser to grab frames, so we 
+            # need a way to detect if things have gone awry.  
+            if t-s.recv_t>STALL_TIMEOUT:
+                logger.debug("removing")
+                self.streams.remove(s)
+                # Wake up recv() so that it can end the track.
+                try:
+                    s.loop.call_soon_threadsafe(s.end)
+                except RuntimeError: # event loop is closed
+                    pass
+                continue
+            # Hand the frame to the stream's event loop.  This never blocks 
+            # the encoder thread, no matter how slow the client is. 
             try:
-                s.queue.put((data, self.timestamp(s.pts)), timeout=2*QUEUE_TIMEOUT)
-                s.timeouts = 0
-            except Full:
-                logger.debug("queue put timeout " + str(s.timeouts))
-                s.timeouts += 1
-                if s.timeouts>=MAX_TIMEOUTS:
-                    logger.debug("removing")
-                    self.streams.remove(s) 
-            s.pts += self.current_frameperiod
+                s.loop.call_soon_threadsafe(s.deliver, data, self.timestamp(s.pts), keyframe, t_handoff)
+            except RuntimeError: # event loop is closed
+                self.streams.remove(s)
+                continue
+            s.pts += layer.current_frameperiod
         self.slock.release()
+        self.profiler.mark("handoff", t_handoff)
 
     def run(self):
         logger.debug("encoder thread start")
-        tn = time.time()
+        t = time.time()
+        for layer in self.layers:
+            layer.tn = t
         while len(self.streams)>0:
+            # Hold our own reference while we encode so that push_frame() can 
+            # replace (and release) the frame in the meantime.  
+            self.flock.acquire()
             frame = self.mr_frame
-            if frame is not None:
-                self.encode_and_send(frame)
+            ref = self.mr_ref.retain() if self.mr_ref else None
+            self.flock.release()
+            t = time.time()
+            # Each layer runs at its own frameperiod.  Only encode layers that
+            # are due and that have streams assigned to them.
+            for layer in self.layers:
+                if t<layer.tn:
+                    continue
+                if frame is not None and any(s.layer is layer for s in self.streams):
+                    self.encode_and_send(layer, *frame)
+                layer.tn += layer.current_frameperiod
+                if layer.tn<t:
+                    # Give ourselves a break if we're behind
+                    layer.tn = t
+            if ref:
+                ref.release()
             if logger.level==logging.DEBUG:
                 fps()
-            # Deal with residual time
-            tn += self.current_frameperiod
-            t = time.time()
             # Calculate how much time we have left over and sleep that much.
-            tsleep = tn - t
+            tsleep = min(layer.tn for layer in self.layers) - time.time()
             if tsleep>0:
                 time.sleep(tsleep)
-            else:
-                # Give ourselves a break if we're behind
-                tn = t 
         logger.debug("encoder thread done")
-        self.thread = self.actual_bitrate = self.bitrate_t0 = None
-        self.current_padding = MIN_PADDING
-        self.target_bitrate_t0 = self.bitrate_n = 0 
+        # Don't keep a pool buffer while there are no streams.
+        self.flock.acquire()
+        ref = self.mr_ref
+        if ref:
+            self.mr_frame = self.mr_ref = None
+        self.flock.release()
+        if ref:
+            ref.release()
+        self.thread = None
+        for layer in self.layers:
+            layer.reset()
+
+
+# aiortc creates an encoder for each RTCRtpSender by calling get_encoder().  In 
+# simulcast mode we give each sender one of these so that REMB updates (which 
+# aiortc delivers by setting target_bitrate) can be attributed to the sender's 
+# StreamTrack instead of being pooled across all clients. 
+class SenderEncoder(aiortc.codecs.base.Encoder):
+    def __init__(self, encoder):
+        self.encoder = encoder
+        self.stream = None
+        self._target_bitrate = None
+
+    def encode(self, stream, force_keyframe):
+        if self.stream is None:
+            self.stream = stream
+            # Apply any REMB value that arrived before the first frame.
+            if self._target_bitrate is not None:
+                self.encoder.update_stream_bitrate(stream, self._target_bitrate)
+        return self.encoder.encode(stream, force_keyframe)
+
+    @property
+    def target_bitrate(self):
+        return self._target_bitrate
+
+    @target_bitrate.setter 
+    def target_bitrate(self, val):
+        self._target_bitrate = val
+        if self.stream is not None:
+            self.encoder.update_stream_bitrate(self.stream, val)
 
 
 class StreamTrack(MediaStreamTrack):
-    def __init__(self, kind, encoder):
+    def __init__(self, kind, encoder, remote_addr=None):
         super().__init__()
         self.kind = kind
         self.encoder = encoder
-        self.queue = Queue(maxsize=1) # Queue is only 1 deep to prevent wind-up.
-        self.timeouts = 0
+        self.remote_addr = remote_addr
+        # StreamTrack is created on the event loop (in the offer handler). 
+        self.loop = asyncio.get_event_loop()
+        # Latest-value slot -- only the newest frame is kept to prevent wind-up.
+        self.slot = None
+        self.event = asyncio.Event()
+        self.current = None
+        self.t_handoff = None
+        # Set after a dropped frame until the next keyframe, and when the 
+        # stream has been removed by the encoder
+        self.resync = False
+        self.resync_t0 = 0
+        self.ended = False
+        self.recv_t = time.time()
+        self.frames = 0
+        self.drops = 0
         self.pts = 0
+        self.layer = None
+        self.remb = deque(maxlen=REMB_HISTORY)
         self.encoder.add_stream(self) 
 
     def stop(self):
@@ -363,7 +554,50 @@ class StreamTrack(MediaStreamTrack):
         super().stop()
         self.encoder.remove_stream(self)
 
+    # Called on the event loop by way of call_soon_threadsafe().
+    def deliver(self, data, timestamp, keyframe=False, t_handoff=None):
+        self.t_handoff = t_handoff
+        if self.slot is not None and self.slot[0]:
+            # The client hasn't picked up the previous frame yet, so drop it
+            # in favor of this one.  The client's decoder has lost its 
+            # reference frame, so it needs a keyframe.
+            self.drops += 1
+            if not self.resync:
+                self.resync = True
+                self.resync_t0 = time.time()
+        if self.resync:
+            if keyframe:
+                self.resync = False
+            else:
+                # Send nothing until the next keyframe on our layer, which 
+                # doesn't affect the other clients.  Force one only if it's 
+                # taking too long.  
+                data = []
+                t = time.time()
+                if t-self.resync_t0>RESYNC_TIMEOUT:
+                    self.encoder.resync(self.layer)
+                    self.resync_t0 = t
+        self.frames += 1
+        self.slot = data, timestamp
+        self.event.set()
+
+    # Called on the event loop when the encoder removes the stream.
+    def end(self):
+        self.ended = True
+        self.event.set()
+
     async def recv(self):
+        await self.event.wait()
+        self.event.clear()
+        if self.ended:
+            self.stop()
+            raise MediaStreamError
+        self.current = self.slot
+        self.slot = None
+        self.recv_t = time.time()
+        # Time from the encoder thread handing off the frame to the client 
+        # picking it up.
+        self.encoder.profiler.mark("delivery", self.t_handoff)
         return self
 
 
@@ -399,10 +633,10 @@ class Streamer:
 
     encoder = None
 
-    def __init__(self, server=None, html=index_html, js=client_js):
+    def __init__(self, server=None, html=index_html, js=client_js, simulcast=False, profile=False):
         self.pcs = set()
         if Streamer.encoder is None:
-            Streamer.encoder = Encoder()
+            Streamer.encoder = Encoder(simulcast=simulcast, profile=profile)
             self.register_encoder()
         else:
             raise RuntimeError("only one instance of Streamer is allowed")
@@ -423,6 +657,11 @@ class Streamer:
                 return Response(client_js, mimetype='application/javascript')
 
 
+        # Encoder pipeline timing, see Profiler
+        @self.server.route('/streamer/profile')
+        async def profile_stats():
+            return jsonify(self.profiler.stats())
+
         @self.server.route('/offer', methods=['POST'])
         async def offer():
             params = await request.get_json()
@@ -446,7 +685,7 @@ class Streamer:
 
             for t in pc.getTransceivers():
                 if t.kind == "video":
-                    track = StreamTrack('video', Streamer.encoder)
+                    track = StreamTrack('video', Streamer.encoder, request.remote_addr)
                     pc.addTrack(track)
 
             answer = await pc.createAnswer()
@@ -473,24 +712,56 @@ class Streamer:
     def send_keyframe(self):
         Streamer.encoder.send_keyframe()
 
-    def push_frame(self, frame, frameperiod=0):
+    def stats(self):
+        return Streamer.encoder.stats()
+
+    @property
+    def profiler(self):
+        return Streamer.encoder.profiler
+
+    def push_frame(self, frame, frameperiod=0, format="BGR24"):
         # If we get a tuple, assume that it's a (frame, timestamp, index) tuple
         # and toss the timestamp and index.
         if isinstance(frame, tuple):
             frame = frame[0]
+        t = self.profiler.start()
+        if format not in FORMATS:
+            raise RuntimeError(f"Unsupported frame format {format}")
+        # The encoder thread picks up the frame later, so it gets its own 
+        # reference to a FrameRef's buffer (no copy).  
+        ref = None
+        if isinstance(frame, FrameRef):
+            ref = frame.retain()
+            frame = ref.frame
+        source = frame
         if frame.dtype!="uint8":
             frame = frame.astype("uint8")
-        if len(frame.shape)==2:
-            frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
-        if len(frame.shape)!=3 and frame.shape[2]!=3:
-            raise RuntimeError("Frames need to be 3 dimensions -- width x height x 3 channels")   
-        Streamer.encoder.push_frame(frame, frameperiod)
+        if format=="BGR24":
+            if len(frame.shape)==2:
+                frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+            if len(frame.shape)!=3 and frame.shape[2]!=3:
+                if ref:
+                    ref.release()
+                raise RuntimeError("Frames need to be 3 dimensions -- width x height x 3 channels")   
+        # YUV frames are passed straight through to the encoder.
+        elif len(frame.shape)!=2 or frame.shape[0]%3!=0:
+            if ref:
+                ref.release()
+            raise RuntimeError("YUV frames need to be 2 dimensions -- width x height*3/2")   
+        # If the frame was converted, we don't need the buffer anymore.
+        if ref and frame is not source:
+            ref.release()
+            ref = None
+        self.profiler.mark("push", t)
+        Streamer.encoder.push_frame(frame, frameperiod, format, ref)
 
     def register_encoder(self):
         def _get_encoder(codec):
             mimeType = codec.mimeType.lower()
 
             if mimeType == "video/h264":
+                if Streamer.encoder.simulcast:
+                    return SenderEncoder(Streamer.encoder)
                 return Streamer.encoder
             else:
                 return __get_encoder(codec)
@@ -10,59 +10,241 @@
 
 import json
 import os
-from kritter import KimageDetector
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from kritter import KimageDetector, Detections
 from tflite_support.task import core
 from tflite_support.task import processor
 from tflite_support.task import vision
 import cv2
 
 BASEDIR = os.path.dirname(__file__)
+# Tiles are sized to the model's input resolution (efficientdet_lite0 is 
+# 320x320) so that tile contents aren't downscaled by the model.
+TILE_SIZE = 320
+# Overlap between neighboring tiles -- objects smaller than this are fully 
+# contained by at least one tile.
+TILE_OVERLAP = 64
+# Boxes of the same class that overlap more than this are merged by nms(). 
+# Overlap is intersection over union, except for boxes that are cut by a tile
+# seam -- such a partial box lies mostly inside the box of the same object 
+# from the full frame or a neighboring tile, so intersection over the smaller 
+# box is used. 
+NMS_THRESHOLD = 0.5
+# A box within this many pixels of a tile edge (that isn't an image edge) is
+# considered cut by the seam.
+SEAM_MARGIN = 2
+# Motion detection (adaptive tiling) is carried out on frames downscaled by 
+# this factor. 
+MOTION_SCALE = 8
+# Minimum pixel difference and fraction of a tile's pixels that must change 
+# for the tile to be considered to have motion.
+MOTION_THRESHOLD = 20
+MOTION_FRACTION = 0.002
+# The interpreter's score threshold is set once, when it's created, to the 
+# lower of the detector's threshold and this.  detect() thresholds above it are
+# applied in NumPy, so changing the threshold never reloads the model. 
+MIN_THRESHOLD = 0.1
+# One row per detection, filled directly from the interpreter's results
+DETECTION_DTYPE = np.dtype([("box", int, 4), ("score", float), ("index", int), ("class", object)])
+
+
+def nms(boxes, scores, classes, threshold=NMS_THRESHOLD, sources=None, cut=None):
+    # Greedy non-maximum suppression within each class.  Returns indexes of the 
+    # boxes to keep, highest score first.  Overlap is intersection over union,
+    # so nested objects of the same class (a person in front of a larger 
+    # person) are kept.  sources (the tile each box came from) and cut (True
+    # for boxes cut by a tile seam) are optional -- pairs from different 
+    # sources where either box is cut use intersection over the smaller box.
+    boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+    order = np.argsort(-np.asarray(scores), kind="stable")
+    boxes = boxes[order]
+    classes = np.asarray(classes)[order]
+    area = (boxes[:, 2] - boxes[:, 0] + 1)*(boxes[:, 3] - boxes[:, 1] + 1)
+    w = np.minimum(boxes[:, None, 2], boxes[None, :, 2]) - np.maximum(boxes[:, None, 0], boxes[None, :, 0]) + 1
+    h = np.minimum(boxes[:, None, 3], boxes[None, :, 3]) - np.maximum(boxes[:, None, 1], boxes[None, :, 1]) + 1
+    inter = np.maximum(0, w)*np.maximum(0, h)
+    overlap = inter/(area[:, None] + area[None, :] - inter)
+    if sources is not None and cut is not None:
+        sources = np.asarray(sources)[order]
+        cut = np.asarray(cut, dtype=bool)[order]
+        seam = (cut[:, None] | cut[None, :]) & (sources[:, None]!=sources[None, :])
+        overlap[seam] = (inter/np.minimum(area[:, None], area[None, :]))[seam]
+    overlap[classes[:, None]!=classes[None, :]] = 0
+    # Only a higher-scoring box can suppress a lower-scoring one. 
+    overlap = np.triu(overlap>threshold, 1)
+    keep = np.ones(len(boxes), dtype=bool)
+    for i in range(len(boxes)):
+        if keep[i]:
+            keep[overlap[i]] = False
+    return order[keep]
+
+
+def tile_grid(resolution, tile_size=TILE_SIZE, overlap=TILE_OVERLAP):
+    # Returns (x0, y0, x1, y1) tiles that cover an image of the given resolution
+    # with at least the given overlap. Tiles are evenly spaced and no larger 
+    # than the image.
+    def spans(length):
+        size = min(tile_size, length)
+        if size==length:
+            return [(0, length)]
+        n = int(np.ceil((length - overlap)/(size - overlap)))
+        starts = np.linspace(0, length - size, n).astype(int).tolist()
+        return [(s, s + size) for s in starts]
+    return [(x0, y0, x1, y1) for y0, y1 in spans(resolution[1]) for x0, x1 in spans(resolution[0])]
+
 
 class TFliteDetector(KimageDetector):
-    def __init__(self, model=None, threshold=0.75):
+    # If tiled is True, detect() runs the model on the full frame and on 
+    # overlapping tiles of tile_size pixels, and merges the results with nms().
+    # This improves recall of small objects in high-resolution frames, which 
+    # the model would otherwise downscale to its input size.  workers is the 
+    # number of interpreters that run tiles in parallel.  If motion is True, 
+    # only tiles with motion (relative to the previous frame) are run.  If 
+    # columns is True, detect() returns Detections instead of a list of dicts.
+    def __init__(self, model=None, threshold=0.75, tiled=False, tile_size=TILE_SIZE, tile_overlap=TILE_OVERLAP, motion=False, workers=1, columns=False):
         super().__init__()
         # If model isn't specified, use the common objects network
         if not model:
             model = os.path.join(BASEDIR, "efficientdet_lite0.tflite")
         self.get_info(model)
         self.threshold = threshold
-        base_options = core.BaseOptions(file_name=model, use_coral=False, num_threads=4)
-        detection_options = processor.DetectionOptions(score_threshold=0.1)
+        self.tiled = tiled
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        self.motion = motion
+        self.prev = None
+        self.model = model
+        self.workers = workers
+        self.columns = columns
+        # Preprocessing buffers, reused from frame to frame, see _buffer() 
+        self.buffers = {}
+        self.score_threshold = min(threshold, MIN_THRESHOLD)
+        self.detectors = [self.create_detector(model, max(1, 4//workers), self.score_threshold) for i in range(workers)]
+        self.detector = self.detectors[0]
+        self.executor = ThreadPoolExecutor(workers) if workers>1 else None
+
+    def create_detector(self, model, num_threads=4, score_threshold=0.1):
+        base_options = core.BaseOptions(file_name=model, use_coral=False, num_threads=num_threads)
+        detection_options = processor.DetectionOptions(score_threshold=score_threshold)
         options = vision.ObjectDetectorOptions(base_options=base_options, detection_options=detection_options)
-        self.detector = vision.ObjectDetector.create_from_options(options)
+        return vision.ObjectDetector.create_from_options(options)
+
+    def _buffer(self, key, shape):
+        # Returns a persistent uint8 buffer of the given shape.  key allows 
+        # workers to have their own buffers. 
+        try:
+            buf = self.buffers[key]
+            if buf.shape==shape:
+                return buf
+        except KeyError:
+            pass
+        buf = self.buffers[key] = np.empty(shape, dtype=np.uint8)
+        return buf
+
+    def _detect(self, detector, image, threshold, offset=(0, 0)):
+        # Returns detections as (boxes, scores, classes, indexes) arrays with 
+        # boxes translated by offset. 
+        # TensorImage needs contiguous memory, so tiles are copied into a 
+        # per-worker buffer. 
+        if not image.flags['C_CONTIGUOUS']:
+            buf = self._buffer(id(detector), image.shape)
+            np.copyto(buf, image)
+            image = buf
+        input_tensor = vision.TensorImage.create_from_array(image)
+        # Run object detection estimation using the model.
+        detected = detector.detect(input_tensor).detections
+        # Copy the results into a preallocated array in a single pass.  A 
+        # detection's categories are sorted by score, highest first. 
+        rows = np.empty(len(detected), dtype=DETECTION_DTYPE)
+        for i, d in enumerate(detected):
+            bb, c = d.bounding_box, d.classes[0]
+            rows[i] = (bb.origin_x, bb.origin_y, bb.width, bb.height), c.score, c.index, c.class_name
+        # Detections below the interpreter's score threshold are already 
+        # filtered out. 
+        if threshold>self.score_threshold:
+            rows = rows[rows["score"]>=threshold]
+        boxes = rows["box"]
+        boxes[:, 2:4] += boxes[:, 0:2]
+        np.maximum(boxes[:, 0:2], 0, out=boxes[:, 0:2])
+        boxes += (*offset, *offset)
+        return boxes, rows["score"], rows["class"].tolist(), rows["index"]
+
+    @staticmethod
+    def _cut(boxes, tile, resolution):
+        # Returns True for boxes that touch an edge of tile that's inside the 
+        # image, i.e. boxes that may be cut by the tile seam.  
+        x0, y0, x1, y1 = tile
+        cut = np.zeros(len(boxes), dtype=bool)
+        if x0>0:
+            cut |= boxes[:, 0]<=x0 + SEAM_MARGIN
+        if y0>0:
+            cut |= boxes[:, 1]<=y0 + SEAM_MARGIN
+        if x1<resolution[0]:
+            cut |= boxes[:, 2]>=x1 - 1 - SEAM_MARGIN
+        if y1<resolution[1]:
+            cut |= boxes[:, 3]>=y1 - 1 - SEAM_MARGIN
+        return cut
+
+    def motion_tiles(self, image, tiles):
+        # Returns the tiles that have changed since the previous frame.  All 
+        # tiles are returned for the first frame. 
+        small = cv2.cvtColor(image[::MOTION_SCALE, ::MOTION_SCALE], cv2.COLOR_RGB2GRAY)
+        prev, self.prev = self.prev, small
+        if prev is None or prev.shape!=small.shape:
+            return tiles
+        moving = cv2.absdiff(small, prev)>MOTION_THRESHOLD
+        res = []
+        for tile in tiles:
+            x0, y0, x1, y1 = [int(i/MOTION_SCALE) for i in tile]
+            if np.count_nonzero(moving[y0:y1, x0:x1])>MOTION_FRACTION*(x1 - x0)*(y1 - y0):
+                res.append(tile)
+        return res
 
- 
     def detect(self, image, threshold=None):
         if not threshold:
             threshold = self.threshold
-        res = []
-        orig_resolution = (image.shape[1], image.shape[0])
-        # Efficientdet can handle full-res frames without much slowdown, but there's an 
-        # improvement in accuracy, so there's little need to downscale
-        #new_resolution = (640, 480)
-        #scale = (orig_resolution[0]/new_resolution[0], orig_resolution[1]/new_resolution[1])
-        #image = cv2.resize(image, new_resolution)
-        scale = (1, 1)
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        input_tensor = vision.TensorImage.create_from_array(image)
-        # Run object detection estimation using the model.
-        detected = self.detector.detect(input_tensor)
-        for d in detected.detections:
-            scores = [c.score for c in d.classes]
-            max_score = max(scores)
-            if max_score<threshold:
-                continue
-            max_index = scores.index(max_score)
-            box = [int(d.bounding_box.origin_x*scale[0]), int(d.bounding_box.origin_y*scale[1]), int((d.bounding_box.origin_x+d.bounding_box.width)*scale[0]), int((d.bounding_box.origin_y+d.bounding_box.height)*scale[1])]
-            box = [0 if i<0 else i for i in box]
-            obj = {
-                "box": box,
-                "class": d.classes[max_index].class_name, 
-                "score": d.classes[max_index].score,
-                "index": d.classes[max_index].index
-            }
-            res.append(obj)
-        return res  
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=self._buffer("rgb", image.shape))
+        # Efficientdet can handle full-res frames without much slowdown, so 
+        # there's no need to downscale. 
+        dets = [self._detect(self.detector, image, threshold)]
+        resolution = (image.shape[1], image.shape[0])
+        # The region (full frame or tile) that each entry of dets came from
+        regions = [(0, 0, *resolution)]
+        if self.tiled:
+            tiles = tile_grid(resolution, self.tile_size, self.tile_overlap)
+            if self.motion:
+                tiles = self.motion_tiles(image, tiles)
+            # A single tile covering the whole frame is the same as the full frame.  
+            if len(tiles)>1:
+                if self.executor:
+                    n = len(self.detectors)
+                    groups = [tiles[i::n] for i in range(n)]
+                    run = lambda detector, group: [self._detect(detector, image[t[1]:t[3], t[0]:t[2]], threshold, t[0:2]) for t in group]
+                    for group, res in zip(groups, self.executor.map(run, self.detectors, groups)):
+                        dets += res
+                        regions += group
+                else:
+                    for t in tiles:
+                        dets.append(self._detect(self.detector, image[t[1]:t[3], t[0]:t[2]], threshold, t[0:2]))
+                        regions.append(t)
+        boxes, scores, classes, indexes = dets[0]
+        if len(dets)>1:
+            boxes = np.concatenate([d[0] for d in dets])
+            scores = np.concatenate([d[1] for d in dets])
+            classes = [c for d in dets for c in d[2]]
+            indexes = np.concatenate([d[3] for d in dets])
+            sources = np.concatenate([np.full(len(d[0]), i) for i, d in enumerate(dets)])
+            cut = np.concatenate([self._cut(d[0], t, resolution) for d, t in zip(dets, regions)])
+            keep = nms(boxes, scores, indexes, sources=sources, cut=cut)
+            boxes, scores, indexes = boxes[keep], scores[keep], indexes[keep]
+            classes = [classes[i] for i in keep]
+        dets = Detections(boxes, scores, classes, indexes)
+        return dets if self.columns else dets.tolist()
+
+    def close(self):
+        if self.executor:
+            self.executor.shutdown()
 
     def get_info(self, model):
         assert(model.endswith("tflite"))